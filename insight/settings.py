@@ -35,6 +35,21 @@ EMAIL_PORT = 587
 DEFAULT_FROM_EMAIL = 'noreply@survey.innovationiseasy.com'
 # EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # During development only
 
+# Report PDF rendering: number of concurrent wkhtmltopdf workers, maximum queued
+# reports and seconds before a wkhtmltopdf process is killed
+PDF_RENDER_WORKERS = 2
+PDF_RENDER_QUEUE_SIZE = 32
+PDF_RENDER_TIMEOUT = 120
+# 'wkhtmltopdf' renders the HTML report, 'direct' draws the PDF in-process
+REPORT_PDF_ENGINE = 'wkhtmltopdf'
+# Number of reports the run_report_worker command generates at once
+REPORT_WORKER_CONCURRENCY = 2
+# 'buffered' appends single-page survey submissions to a log in RESPONSE_LOG_DIR
+# for the flush_responses command to save in batches; 'direct' saves them at once.
+# The log is per node: use 'buffered' only with a single web node, see main.ingest
+RESPONSE_INGEST_MODE = 'direct'
+RESPONSE_LOG_DIR = os.path.join(BASE_DIR, 'response_log')
+
 # Application definition
 
 INSTALLED_APPS = [
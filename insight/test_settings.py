@@ -0,0 +1,23 @@
+"""
+Settings for running the test suite locally: SQLite instead of MySQL, and
+in-memory mail, no log file and fast password hashing.
+
+    python manage.py test main --settings=insight.test_settings
+"""
+from .settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'test.sqlite3'),
+    }
+}
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+LOGGING = {'version': 1, 'disable_existing_loggers': False}
+
+# Reports are drawn in-process so no wkhtmltopdf is needed; see main.tests for chart stubs
+REPORT_PDF_ENGINE = 'direct'
+RESPONSE_INGEST_MODE = 'direct'
+RESPONSE_LOG_DIR = os.path.join(BASE_DIR, 'test_response_log')
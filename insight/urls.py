@@ -16,14 +16,20 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin
 from main import views
+from main.forms import OutboxPasswordResetForm
 from django.contrib.auth import views as auth_views
 admin.autodiscover()
 
 urlpatterns = [
     url(r'^admin/view_data$', views.view_data, name='view_data'),
+    url(r'^admin/data/users$', views.users_data, name='users_data'),
+    url(r'^admin/data/surveys$', views.surveys_data, name='surveys_data'),
+    url(r'^admin/data/responses$', views.responses_data, name='responses_data'),
+    url(r'^admin/export/(?P<table>responses|users)\.csv$', views.export_data, name='export_data'),
     url(r'^login', views.login, name='login'),
     url(r'^logout', views.logout, name='logout'),
-    url(r'^password_reset/$', auth_views.PasswordResetView.as_view(template_name='password_reset.html',
+    url(r'^password_reset/$', auth_views.PasswordResetView.as_view(form_class=OutboxPasswordResetForm,
+                                                                   template_name='password_reset.html',
                                                                    email_template_name='password_reset_email.html',
                                                                    subject_template_name='password_reset_subject.txt',
                                                                    from_email='no_reply@innovationiseasy.com'),
@@ -1,6 +1,10 @@
 from django.contrib import admin
-from .models import Survey, SurveyResponse
+from .models import Survey, SurveyResponse, ResponseHistogram, ReportJob, OutboxMessage, OutboxAttachment
 
 
 admin.site.register(Survey)
 admin.site.register(SurveyResponse)
+admin.site.register(ResponseHistogram)
+admin.site.register(ReportJob)
+admin.site.register(OutboxMessage)
+admin.site.register(OutboxAttachment)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for caching rendered Innovation Company report charts
+
+Every report chart depends only on a handful of response counts plus fixed
+styling, so identical charts recur constantly across surveys. Rendered images
+are kept in a bounded in-memory LRU backed by an on-disk tier, both keyed by a
+hash of the chart kind, its counts and the renderer style version. The disk
+tier is bounded too: once it holds too many images or bytes, the least
+recently used files are deleted.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+from .chart_renderer import STYLE_VERSION
+
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_DISK_ENTRIES = 4096
+DEFAULT_MAX_DISK_BYTES = 64 * 1024 * 1024
+CHART_SUFFIX = '.chart'
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'insight_chart_cache')
+
+
+class ChartCache(object):
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, directory=DEFAULT_DIRECTORY,
+                 max_disk_entries=DEFAULT_MAX_DISK_ENTRIES, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """Two-tier cache of rendered chart images.
+
+        Args:
+            max_entries (int): Maximum number of images held in memory; the
+                least recently used image is evicted first.
+            directory (str, optional): Directory of the on-disk tier. If None,
+                only the in-memory tier is used.
+            max_disk_entries (int): Maximum number of images kept on disk.
+            max_disk_bytes (int): Maximum total size of the images kept on
+                disk. Past either limit, the least recently used files are
+                deleted first.
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(kind, counts, backend):
+        """Builds the content address of a chart.
+
+        Args:
+            kind (str): Chart name, eg. 'overall_risk' or 'grouped_failure'.
+            counts (list of list of int): The bar heights of each trace.
+            backend (str): The chart backend that renders the image.
+
+        Returns:
+            (str): A hex digest identifying the rendered image.
+        """
+        counts = tuple(tuple(int(c) for c in trace) for trace in counts)
+        ident = repr((kind, counts, backend, STYLE_VERSION))
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CHART_SUFFIX)
+
+    def get(self, key):
+        """Returns the cached image for `key`, or None on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+        image = None
+        if self.directory:
+            try:
+                with open(self._path(key), 'rb') as chart_file:
+                    image = chart_file.read()
+                # Mark the file as recently used so it is evicted last
+                os.utime(self._path(key))
+            except (IOError, OSError):
+                image = None
+        with self._lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._remember(key, image)
+        return image
+
+    def put(self, key, image):
+        """Stores a rendered image in both tiers."""
+        with self._lock:
+            self._remember(key, image)
+        if self.directory:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, 'wb') as chart_file:
+                    chart_file.write(image)
+                os.replace(tmp_path, self._path(key))
+                self._trim_disk()
+            except (IOError, OSError):
+                pass
+
+    def _trim_disk(self):
+        """Deletes the least recently used images until the disk tier is within its limits."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(CHART_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except (IOError, OSError):
+                    # Deleted by another process trimming the same directory
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        count = len(files)
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if count <= self.max_disk_entries and total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except (IOError, OSError):
+                pass
+            count -= 1
+            total -= size
+
+    def _remember(self, key, image):
+        self._entries[key] = image
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Empties the in-memory tier and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        """Returns hit/miss counters.
+
+        Returns:
+            (dict of str => int): 'memory_hits', 'disk_hits', 'hits', 'misses'
+                and 'entries' (number of images held in memory).
+        """
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'hits': self.memory_hits + self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+
+CHART_CACHE = ChartCache()
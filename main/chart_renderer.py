@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for rendering Innovation Company report charts in-process
+
+Lays out the same bar chart figures that ~SurveyReportMaker sends to Plot.ly
+(bar traces, annotations, margins, 300x240 layout) and draws them locally as
+SVG, without any network I/O.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+
+# Bump whenever the rendered output changes for the same input data
+STYLE_VERSION = 1
+
+FONT_FAMILY = "Calibri, Helvetica, Arial, sans-serif"
+TEXT_COLOR = "rgb(68, 68, 68)"
+TICK_FONT_SIZE = 12
+LEGEND_FONT_SIZE = 12
+TICK_HEIGHT = 16
+LEGEND_HEIGHT = 18
+LABEL_ROOM = 14
+
+Rect = namedtuple('Rect', ['x', 'y', 'width', 'height', 'fill'])
+Text = namedtuple('Text', ['x', 'y', 'text', 'size', 'anchor', 'angle', 'fill'])
+Chart = namedtuple('Chart', ['width', 'height', 'shapes'])
+
+
+def _get(obj, key, default=None):
+    value = obj.get(key) if obj is not None else None
+    return default if value is None else value
+
+
+def _margin(layout):
+    margin = _get(layout, 'margin', {})
+    return (_get(margin, 'l', 80), _get(margin, 'r', 80),
+            _get(margin, 't', 100), _get(margin, 'b', 80))
+
+
+def layout_chart(figure):
+    """Computes the shapes making up a bar chart figure.
+
+    Args:
+        figure (dict): A figure with `data` (list of bar traces with `x`, `y`,
+            `name` and `marker.color`) and `layout` (width, height, margin,
+            barmode, bargap, bargroupgap, annotations, title), as built by
+            ~SurveyReportMaker._make_plot.
+
+    Returns:
+        (Chart): Width, height and a list of ~Rect and ~Text shapes in pixel
+            coordinates with the origin at the top left corner.
+    """
+    data = list(_get(figure, 'data', []))
+    layout = _get(figure, 'layout', {})
+    width = _get(layout, 'width', 300)
+    height = _get(layout, 'height', 240)
+    left, right, top, bottom = _margin(layout)
+    grouped = _get(layout, 'barmode') == 'group' and len(data) > 1
+    show_legend = len(data) > 1 and any(_get(trace, 'name') for trace in data)
+
+    categories = list(_get(data[0], 'x', [])) if data else []
+    n_cats = max(len(categories), 1)
+    x0 = left
+    x1 = width - right
+    y0 = top + LABEL_ROOM
+    y1 = height - bottom - TICK_HEIGHT - (LEGEND_HEIGHT if show_legend else 0)
+    band = float(x1 - x0) / n_cats
+    y_max = max([max(list(_get(trace, 'y', [])) or [0]) for trace in data] or [0]) or 1
+    y_scale = float(y1 - y0) / y_max
+
+    def to_px(xv, yv):
+        if not isinstance(xv, (int, float)):
+            xv = categories.index(xv)
+        return x0 + band * (xv + 0.5), y1 - yv * y_scale
+
+    shapes = []
+    group_width = band * (1 - _get(layout, 'bargap', 0.2))
+    n_slots = len(data) if grouped else 1
+    slot = group_width / n_slots
+    bar_width = slot * (1 - _get(layout, 'bargroupgap', 0.0))
+    for t, trace in enumerate(data):
+        color = _get(_get(trace, 'marker', {}), 'color', 'rgb(31, 119, 180)')
+        for i, yv in enumerate(_get(trace, 'y', [])):
+            left_edge = x0 + band * i + (band - group_width) / 2 + slot * (t if grouped else 0)
+            bar_height = yv * y_scale
+            shapes.append(Rect(left_edge + (slot - bar_width) / 2, y1 - bar_height,
+                               bar_width, bar_height, color))
+
+    for i, cat in enumerate(categories):
+        shapes.append(Text(x0 + band * (i + 0.5), y1 + TICK_HEIGHT - 3, str(cat),
+                           TICK_FONT_SIZE, 'middle', 0, TEXT_COLOR))
+
+    for ann in _get(layout, 'annotations', []):
+        ax, ay = to_px(_get(ann, 'x', 0), _get(ann, 'y', 0))
+        shapes.append(Text(ax, ay - 2, str(_get(ann, 'text', '')),
+                           _get(_get(ann, 'font', {}), 'size', 12),
+                           'middle', _get(ann, 'textangle', 0), TEXT_COLOR))
+
+    if show_legend:
+        cursor = x0
+        legend_y = height - bottom - LEGEND_HEIGHT / 2
+        for trace in data:
+            name = _get(trace, 'name', '')
+            color = _get(_get(trace, 'marker', {}), 'color', 'rgb(31, 119, 180)')
+            shapes.append(Rect(cursor, legend_y - 5, 10, 10, color))
+            shapes.append(Text(cursor + 14, legend_y + 4, name, LEGEND_FONT_SIZE, 'start', 0, TEXT_COLOR))
+            cursor += 24 + 7 * len(name)
+
+    title = _get(layout, 'title')
+    if title:
+        shapes.append(Text(width / 2.0, top / 2.0 + 6, str(title), 14, 'middle', 0, TEXT_COLOR))
+
+    return Chart(width, height, shapes)
+
+
+def render_svg(figure):
+    """Renders a bar chart figure as an SVG document.
+
+    Args:
+        figure (dict): See ~layout_chart.
+
+    Returns:
+        (bytes): UTF-8 encoded SVG markup.
+    """
+    chart = layout_chart(figure)
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">'
+             % (chart.width, chart.height, chart.width, chart.height),
+             '<rect x="0" y="0" width="%d" height="%d" fill="white"/>' % (chart.width, chart.height)]
+    for shape in chart.shapes:
+        if isinstance(shape, Rect):
+            parts.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s"/>'
+                         % (shape.x, shape.y, shape.width, shape.height, shape.fill))
+        else:
+            transform = ''
+            if shape.angle:
+                transform = ' transform="rotate(%.2f %.2f %.2f)"' % (shape.angle, shape.x, shape.y)
+            parts.append('<text x="%.2f" y="%.2f" font-family="%s" font-size="%d" fill="%s" '
+                         'text-anchor="%s"%s>%s</text>'
+                         % (shape.x, shape.y, FONT_FAMILY, shape.size, shape.fill,
+                            shape.anchor, transform, escape(shape.text)))
+    parts.append('</svg>')
+    return '\n'.join(parts).encode('utf-8')
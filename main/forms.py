@@ -1,6 +1,7 @@
 from django import forms
-from .models import Survey, SurveyResponse
-from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
+from .models import Survey, SurveyResponse, OutboxMessage
+from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, PasswordResetForm
+from django.template import loader
 from django.contrib.auth.models import User
 from django.contrib.staticfiles.templatetags.staticfiles import static
 from django.utils.safestring import mark_safe
@@ -37,6 +38,21 @@ class NewUserForm(UserCreationForm):
         return self.cleaned_data["last_name"]
 
 
+class OutboxPasswordResetForm(PasswordResetForm):
+    """Queues the password reset email in the outbox instead of sending it during the request."""
+
+    def send_mail(self, subject_template_name, email_template_name, context, from_email, to_email,
+                  html_email_template_name=None):
+        subject = loader.render_to_string(subject_template_name, context)
+        # Email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        body = loader.render_to_string(email_template_name, context)
+        html_body = ''
+        if html_email_template_name is not None:
+            html_body = loader.render_to_string(html_email_template_name, context)
+        OutboxMessage.queue(subject, body, [to_email], from_email=from_email, html_body=html_body)
+
+
 class AddSurveyForm(forms.Form):
     survey_name = forms.CharField(max_length=100, required=True)
 
@@ -56,16 +72,46 @@ class Question1Form(forms.Form):
     question = forms.ChoiceField(choices=CHOICES, widget=forms.RadioSelect)
 
 
+RISK_IMAGES = [('a', 'risk_a.jpg', 'High Risk'),
+               ('b', 'risk_b.jpg', 'Medium Risk'),
+               ('c', 'risk_c.jpg', 'Low Risk'),
+               ('d', 'risk_d.jpg', 'No Risk')]
+FAILURE_IMAGES = [('a', 'support_a.jpg', 'Supported'),
+                  ('b', 'support_b.jpg', 'Injured'),
+                  ('c', 'support_c.jpg', 'Booted')]
+
+
+def image_choices(images):
+    """Radio choices labelled with answer images hosted on the current Site.
+
+    Called each time the choices are used, not at import time; the Site comes
+    from the Sites framework's in-process cache after its first lookup. Image
+    URLs come from the staticfiles storage, so a fingerprinting storage such
+    as ManifestStaticFilesStorage is picked up as is.
+    """
+    domain = Site.objects.get_current().domain
+    return [(value, mark_safe("<img class='radioicons' src='http://%s%s' alt='%s' title='%s'>"
+                              % (domain, static('insight/img/' + image), label, label)))
+            for value, image, label in images]
+
+
+def risk_choices():
+    return image_choices(RISK_IMAGES)
+
+
+def failure_choices():
+    return image_choices(FAILURE_IMAGES)
+
+
 class Question2Form(forms.Form):
-    CHOICES = [('a', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/risk_a.jpg' alt='High Risk' title='High Risk'>" % Site.objects.get_current().domain)),
-               ('b', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/risk_b.jpg' alt='Medium Risk' title='Medium Risk'>" % Site.objects.get_current().domain)),
-               ('c', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/risk_c.jpg' alt='Low Risk' title='Low Risk'>" % Site.objects.get_current().domain)),
-               ('d', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/risk_d.jpg' alt='No Risk' title='No Risk'>" % Site.objects.get_current().domain))]
-    question = forms.ChoiceField(choices=CHOICES, widget=forms.RadioSelect)
+    question = forms.ChoiceField(choices=risk_choices, widget=forms.RadioSelect)
 
 
 class Question3Form(forms.Form):
-    CHOICES = [('a', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/support_a.jpg' alt='Supported' title='Supported'>" % Site.objects.get_current().domain)),
-               ('b', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/support_b.jpg' alt='Injured' title='Injured'>" % Site.objects.get_current().domain)),
-               ('c', mark_safe("<img class='radioicons' src='http://%s/static/insight/img/support_c.jpg' alt='Booted' title='Booted'>" % Site.objects.get_current().domain))]
-    question = forms.ChoiceField(choices=CHOICES, widget=forms.RadioSelect)
+    question = forms.ChoiceField(choices=failure_choices, widget=forms.RadioSelect)
+
+
+class SurveyForm(forms.Form):
+    question_1 = forms.ChoiceField(choices=Question1Form.CHOICES, widget=forms.RadioSelect)
+    question_2 = forms.ChoiceField(choices=risk_choices, widget=forms.RadioSelect)
+    question_3 = forms.ChoiceField(choices=failure_choices, widget=forms.RadioSelect)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for write-behind ingestion of survey submissions
+
+In buffered mode a validated submission is appended as one JSON line to a
+durable local log and acknowledged immediately. The `flush_responses` command
+(or ~flush_responses, called by a report job before it counts responses)
+later moves logged submissions into ~models.SurveyResponse with `bulk_create`,
+updating the survey counters and histograms once per batch.
+
+The log is local to one node, so buffered mode supports a single web node
+that also runs `flush_responses` and `run_report_worker`. With more nodes, a
+report may be made before another node's log is flushed; such late responses
+are still saved if they were submitted before the survey closed, with a
+warning, and ones submitted after it closed are dropped.
+
+Writers append under a shared `flock` and flushers rotate the log by renaming
+it and then taking an exclusive lock on the renamed file, which waits for
+appends already in progress. Each entry carries its response id, so a segment
+replayed after a crash never inserts a response twice.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+from collections import defaultdict
+import fcntl
+import glob
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Survey, SurveyResponse, ResponseHistogram, ReportJob
+from .uuids import time_ordered_uuid
+
+
+DIRECT_MODE = 'direct'
+BUFFERED_MODE = 'buffered'
+DEFAULT_BATCH_SIZE = 500
+LOG_NAME = 'responses.log'
+SEGMENT_SUFFIX = '.flushing'
+logger = logging.getLogger('django')
+
+
+def log_directory():
+    return getattr(settings, 'RESPONSE_LOG_DIR', os.path.join(settings.BASE_DIR, 'response_log'))
+
+
+def buffered():
+    """Returns True if submissions should be appended to the log instead of saved."""
+    return getattr(settings, 'RESPONSE_INGEST_MODE', DIRECT_MODE) == BUFFERED_MODE
+
+
+def append(survey_id, question_1, question_2, question_3):
+    """Durably logs a complete submission for a later flush.
+
+    Returns:
+        (str): The id the response will be saved with.
+    """
+    directory = log_directory()
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    response_id = str(time_ordered_uuid())
+    line = json.dumps({'id': response_id, 'survey': str(survey_id), 'question_1': question_1,
+                       'question_2': question_2, 'question_3': question_3,
+                       'submitted_date': timezone.now().isoformat()}) + '\n'
+    path = os.path.join(directory, LOG_NAME)
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            # A flusher may have rotated the log between open and lock; append to the new one instead
+            try:
+                current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                os.write(fd, line.encode('utf-8'))
+                os.fsync(fd)
+                return response_id
+        finally:
+            os.close(fd)
+
+
+def _rotate(directory):
+    """Renames the live log to a new segment, once no append to it is in progress."""
+    path = os.path.join(directory, LOG_NAME)
+    segment = os.path.join(directory, '%.6f%s' % (time.time(), SEGMENT_SUFFIX))
+    try:
+        os.rename(path, segment)
+    except FileNotFoundError:
+        return
+    with open(segment, 'rb') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _read_segment(segment):
+    entries = []
+    with open(segment, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            try:
+                entries.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # Only a torn final line from a crash mid-append can be unreadable
+                logger.error("Skipping unreadable line %d of response log %s" % (number, segment))
+    return entries
+
+
+def _save_batch(entries):
+    """Inserts a batch of logged submissions and counts them, in one transaction."""
+    with transaction.atomic():
+        existing = set(str(pk) for pk in SurveyResponse.objects.filter(pk__in=[e['id'] for e in entries])
+                       .values_list('pk', flat=True))
+        new = [e for e in entries if e['id'] not in existing]
+        closed_dates = dict((str(pk), closed_date) for pk, closed_date in
+                            Survey.objects.filter(pk__in=set(e['survey'] for e in new))
+                            .values_list('pk', 'closed_date'))
+        late = [e for e in new if e['survey'] in closed_dates and closed_dates[e['survey']] is not None
+                and parse_datetime(e['submitted_date']) > closed_dates[e['survey']]]
+        for e in late:
+            logger.warning("Dropping logged response %s to survey %s, submitted after it closed"
+                           % (e['id'], e['survey']))
+        late = set(e['id'] for e in late)
+        new = [e for e in new if e['survey'] in closed_dates and e['id'] not in late]
+        closed = set(e['survey'] for e in new if closed_dates[e['survey']] is not None)
+        if closed:
+            reported = set(str(pk) for pk in ReportJob.objects.filter(survey_id__in=closed).exclude(aggregate='')
+                           .values_list('survey_id', flat=True))
+            for survey_id in reported:
+                logger.warning("Saving logged responses to survey %s after its report was made; "
+                               "the report does not count them" % survey_id)
+        SurveyResponse.objects.bulk_create([
+            SurveyResponse(id=e['id'], survey_id=e['survey'], submitted=True,
+                           submitted_date=parse_datetime(e['submitted_date']),
+                           question_1=e['question_1'], question_2=e['question_2'], question_3=e['question_3'],
+                           response_code=SurveyResponse.encode(e['question_1'], e['question_2'], e['question_3']))
+            for e in new])
+        by_survey = defaultdict(list)
+        for e in new:
+            by_survey[e['survey']].append((e['question_1'], e['question_2'], e['question_3']))
+        for survey_id, answers in by_survey.items():
+            Survey.objects.filter(pk=survey_id).update(started_count=F('started_count') + len(answers),
+                                                       submitted_count=F('submitted_count') + len(answers))
+            ResponseHistogram.record_many(survey_id, answers)
+    return len(new)
+
+
+def flush_responses(batch_size=DEFAULT_BATCH_SIZE):
+    """Moves every logged submission into the database.
+
+    Only one flush runs at a time per log directory; a concurrent call waits
+    for the running one, so on return all submissions logged before the call
+    are saved.
+
+    Returns:
+        (int): Number of responses saved.
+    """
+    directory = log_directory()
+    if not os.path.isdir(directory):
+        return 0
+    saved = 0
+    with open(os.path.join(directory, 'flush.lock'), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        _rotate(directory)
+        for segment in sorted(glob.glob(os.path.join(directory, '*' + SEGMENT_SUFFIX))):
+            entries = _read_segment(segment)
+            for start in range(0, len(entries), batch_size):
+                saved += _save_batch(entries[start:start + batch_size])
+            os.remove(segment)
+    return saved
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for keyset pagination of Django querysets
+
+Pages are ordered by an indexed sort column with the primary key as a tie
+breaker, and the next page starts after the (sort value, pk) of the last row
+of the current one. Unlike OFFSET pagination the database seeks straight to
+the page through the index, so the cost of a page does not grow with its
+position.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+import base64
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+
+MAX_PAGE_SIZE = 100
+ITERATE_CHUNK_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class _CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder rounds times to milliseconds, so a cursor would skip or repeat
+    # rows whose sort values differ by less than that
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(_CursorEncoder, self).default(o)
+
+
+def encode_cursor(sort_value, pk):
+    """Returns an opaque, URL safe cursor for the row with `sort_value` and `pk`."""
+    raw = json.dumps([sort_value, pk], cls=_CursorEncoder)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, model, sort_field):
+    """Returns the (sort value, pk) of a cursor, converted to the model field types."""
+    try:
+        sort_value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        meta = model._meta
+        return meta.get_field(sort_field).to_python(sort_value), meta.pk.to_python(pk)
+    except Exception as e:
+        raise InvalidCursor("Invalid page cursor: %s" % e)
+
+
+def _ordered(queryset, sort):
+    prefix = '-' if sort.startswith('-') else ''
+    return queryset.order_by(sort, prefix + 'pk')
+
+
+def _after(queryset, sort, value, pk):
+    field = sort.lstrip('-')
+    op = 'lt' if sort.startswith('-') else 'gt'
+    return queryset.filter(Q(**{field + '__' + op: value}) | Q(**{field: value, 'pk__' + op: pk}))
+
+
+def paginate(queryset, sort, after=None, limit=MAX_PAGE_SIZE):
+    """Returns one page of a queryset ordered by a sort column and the primary key.
+
+    Args:
+        queryset (~django.db.models.QuerySet): The filtered rows to page through.
+        sort (str): Model field to order by, prefixed with '-' for descending
+            order. The field should be indexed and must not be null.
+        after (str, optional): Cursor of the last row of the previous page, as
+            returned in 'next'. The first page if omitted.
+        limit (int): Number of rows per page, at most MAX_PAGE_SIZE.
+
+    Returns:
+        (list of ~django.db.models.Model, str): The rows of the page and the
+            cursor of the next page, or None if this is the last page.
+    """
+    field = sort.lstrip('-')
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    if after:
+        queryset = _after(queryset, sort, *decode_cursor(after, queryset.model, field))
+    rows = list(_ordered(queryset, sort)[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, queryset.model._meta.get_field(field).attname), last.pk)
+
+
+def iterate(queryset, sort='pk', chunk_size=ITERATE_CHUNK_SIZE):
+    """Yields every row of a queryset, fetching `chunk_size` rows per query.
+
+    Each chunk is a separate keyset query, so only one chunk is held in memory
+    at a time whatever the database driver, and no transaction or cursor stays
+    open between chunks.
+    """
+    field = sort.lstrip('-')
+    attname = queryset.model._meta.get_field(field).attname if field != 'pk' else 'pk'
+    page = queryset
+    while True:
+        rows = list(_ordered(page, sort)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        page = _after(queryset, sort, getattr(rows[-1], attname), rows[-1].pk)
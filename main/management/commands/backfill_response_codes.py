@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from main.models import SurveyResponse
+from main.score_innovation import ROLES, RISK_ANSWERS, FAILURE_ANSWERS, encode_response
+
+
+class Command(BaseCommand):
+    help = "Sets the response code of submitted survey responses saved before response codes existed."
+
+    def handle(self, *args, **options):
+        updated = 0
+        # One UPDATE per answer combination rather than one per response
+        for role in ROLES:
+            for risk in RISK_ANSWERS:
+                for failure in FAILURE_ANSWERS:
+                    updated += SurveyResponse.objects.filter(response_code__isnull=True, submitted=True,
+                                                             question_1=role, question_2=risk, question_3=failure) \
+                        .update(response_code=encode_response(role, risk, failure))
+        self.stdout.write("Set the response code of %d response%s." % (updated, "" if updated == 1 else "s"))
@@ -0,0 +1,44 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+# Run in a fresh interpreter: times the WSGI application import, and reports
+# which heavy report dependencies and DB queries it pulled in
+PROBE = """
+import json, sys, time
+started = time.time()
+import insight.wsgi
+from django.urls import get_resolver
+get_resolver().url_patterns  # views, forms and models load with the URLconf on the first request
+elapsed = time.time() - started
+from django.db import connection
+print(json.dumps({'seconds': elapsed,
+                  'connected': connection.connection is not None,
+                  'heavy': sorted(m for m in %r if m in sys.modules)}))
+"""
+HEAVY_MODULES = ('pdfkit', 'plotly', 'plotly.plotly', 'plotly.graph_objs', 'numpy')
+
+
+class Command(BaseCommand):
+    help = "Measures the cold start time of importing insight.wsgi.application in fresh processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help="Number of fresh processes to time.")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'insight.settings'))
+        results = []
+        for _ in range(options['runs']):
+            out = subprocess.check_output([sys.executable, '-c', PROBE % (HEAVY_MODULES,)],
+                                          cwd=settings.BASE_DIR, env=env)
+            results.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+        times = sorted(r['seconds'] for r in results)
+        self.stdout.write("insight.wsgi + URLconf import: min %.3fs, median %.3fs, max %.3fs over %d runs"
+                          % (times[0], times[len(times) // 2], times[-1], len(times)))
+        self.stdout.write("Report dependencies loaded at startup: %s" % (", ".join(results[-1]['heavy']) or "none"))
+        self.stdout.write("Database connection opened at startup: %s" % ("yes" if results[-1]['connected'] else "no"))
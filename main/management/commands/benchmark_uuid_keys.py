@@ -0,0 +1,62 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from main.uuids import time_ordered_uuid
+
+
+class Command(BaseCommand):
+    help = ("Compares insert throughput and primary key index size of uuid4 and time-ordered UUID keys, "
+            "using scratch tables shaped like main_surveyresponse in the configured database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000, help="Rows inserted per key type.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows per INSERT transaction.")
+
+    def handle(self, *args, **options):
+        for name, generate in (('uuid4', uuid.uuid4), ('time_ordered', time_ordered_uuid)):
+            table = 'bench_uuid_%s' % name
+            self.create_table(table)
+            try:
+                seconds = self.insert(table, generate, options['rows'], options['batch_size'])
+                size = self.table_size(table)
+            finally:
+                with connection.cursor() as cursor:
+                    cursor.execute('DROP TABLE %s' % connection.ops.quote_name(table))
+            self.stdout.write("%-13s %8.0f rows/s  %s" % (name, options['rows'] / seconds,
+                                                           "size n/a on %s" % connection.vendor if size is None
+                                                           else "data %.1f MiB, index %.1f MiB" % size))
+
+    def create_table(self, table):
+        with connection.cursor() as cursor:
+            # Django stores UUIDField as char(32) hex on MySQL and SQLite
+            cursor.execute('CREATE TABLE %s (id char(32) NOT NULL PRIMARY KEY, survey_id char(32) NOT NULL, '
+                           'question_1 varchar(10) NOT NULL, question_2 varchar(1) NOT NULL, '
+                           'question_3 varchar(1) NOT NULL)' % connection.ops.quote_name(table))
+            cursor.execute('CREATE INDEX %s ON %s (survey_id)' % (connection.ops.quote_name(table + '_survey'),
+                                                                  connection.ops.quote_name(table)))
+
+    def insert(self, table, generate, rows, batch_size):
+        survey_id = uuid.uuid4().hex
+        sql = 'INSERT INTO %s (id, survey_id, question_1, question_2, question_3) VALUES (%%s, %%s, %%s, %%s, %%s)' \
+            % connection.ops.quote_name(table)
+        started = time.time()
+        for start in range(0, rows, batch_size):
+            batch = [(generate().hex, survey_id, 'MGR', 'a', 'b') for _ in range(min(batch_size, rows - start))]
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, batch)
+        return time.time() - started
+
+    def table_size(self, table):
+        """Returns the (data, index) size of a table in MiB, or None if the database cannot report it."""
+        if connection.vendor != 'mysql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE TABLE %s' % connection.ops.quote_name(table))
+            cursor.fetchall()
+            cursor.execute('SELECT data_length, index_length FROM information_schema.tables '
+                           'WHERE table_schema = DATABASE() AND table_name = %s', [table])
+            data, index = cursor.fetchone()
+        return data / 2.0 ** 20, index / 2.0 ** 20
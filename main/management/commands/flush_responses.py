@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from main.ingest import flush_responses, DEFAULT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Saves survey submissions from the buffered response log to the database in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Number of responses inserted per transaction.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep flushing the log instead of exiting once it is empty.")
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help="Seconds between flushes with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            saved = flush_responses(options['batch_size'])
+            if saved:
+                self.stdout.write("Saved %d response%s." % (saved, "" if saved == 1 else "s"))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
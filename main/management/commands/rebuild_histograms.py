@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Survey, ResponseHistogram
+
+
+class Command(BaseCommand):
+    help = "Recomputes the per-survey response histograms and counters from the raw survey responses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', help="Surveys to rebuild; all surveys if omitted.")
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        if options['survey_ids']:
+            surveys = surveys.filter(pk__in=options['survey_ids'])
+        rebuilt = 0
+        for survey in surveys.only('pk').iterator():
+            ResponseHistogram.rebuild(survey.pk)
+            survey.recount()
+            rebuilt += 1
+        self.stdout.write("Rebuilt %d survey histogram%s." % (rebuilt, "" if rebuilt == 1 else "s"))
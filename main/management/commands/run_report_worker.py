@@ -0,0 +1,52 @@
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from main.models import ReportJob
+
+
+class Command(BaseCommand):
+    help = "Runs queued report jobs, retrying failed reports on their scheduled time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int,
+                            default=getattr(settings, 'REPORT_WORKER_CONCURRENCY', 2),
+                            help="Number of reports generated at once.")
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help="Seconds to wait before checking an empty queue again.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once no job is due instead of polling.")
+
+    def handle(self, *args, **options):
+        self.stop = threading.Event()
+        threads = [threading.Thread(target=self.work, args=(options['poll_interval'], options['once']),
+                                    name="report-worker-%d" % i)
+                   for i in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping after the running jobs finish...")
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, poll_interval, once):
+        try:
+            while not self.stop.is_set():
+                close_old_connections()
+                job = ReportJob.claim_next()
+                if job is None:
+                    if once:
+                        return
+                    self.stop.wait(poll_interval)
+                    continue
+                job.run()
+                self.stdout.write("Report job %s: %s (attempt %d)" % (job.pk, job.status, job.attempts))
+        finally:
+            connection.close()
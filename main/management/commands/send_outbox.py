@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from main.outbox import flush_outbox
+
+
+# Longest wait between flushes while the mail server or database keeps failing
+MAX_BACKOFF_SECONDS = 5 * 60
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = "Sends queued outgoing emails in batches over a reused SMTP connection."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Number of messages claimed per batch.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep flushing the outbox instead of exiting once it is empty.")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds between flushes with --loop.")
+
+    def handle(self, *args, **options):
+        delay = options['interval']
+        while True:
+            close_old_connections()
+            try:
+                sent, failed = flush_outbox(options['batch_size'])
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                # Unsent messages stay queued; wait longer after each consecutive failure
+                delay = min(max(delay, 1.0) * 2, MAX_BACKOFF_SECONDS)
+                logger.error("FAILED TO FLUSH OUTBOX, retrying in %d seconds: %s" % (delay, e))
+            else:
+                delay = options['interval']
+                if sent or failed:
+                    self.stdout.write("Sent %d email%s, %d failed." % (sent, "" if sent == 1 else "s", failed))
+                if not options['loop']:
+                    return
+            time.sleep(delay)
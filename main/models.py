@@ -1,40 +1,66 @@
 # coding=utf-8
-from time import sleep
-from django.db import models
+import base64
+from datetime import timedelta
+import json
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, Q
 from django.template.loader import render_to_string
-# from django.utils import timezone
+from django.utils import timezone
 import uuid
-from django.core.mail import send_mail, EmailMessage
 # from django.utils.html import strip_tags
-from .survey_maker import SurveyReportMaker
-import pdfkit
+from .survey_maker import SurveyReportMaker, CHART_NAMES
 import logging
 import os
-from .score_innovation import get_rating
-from django.core.mail import EmailMultiAlternatives
+from .score_innovation import get_rating_from_counts, encode_response, decode_response, ROLES, RISK_ANSWERS, \
+    FAILURE_ANSWERS, N_MGR_COMBINATIONS
+from . import pdf_pool
+from .uuids import time_ordered_uuid
+from django.conf import settings
+from django.core.cache import cache
 
 
 
 MIN_RESPONSES = 1
 MAX_REPORT_ATTEMPTS = 10
+REPORT_RETRY_DELAY = 120  # seconds, multiplied by the number of attempts so far
+REPORT_LEASE_SECONDS = 15 * 60  # seconds a worker may hold a job without finishing a stage
+OUTBOX_LEASE_SECONDS = 10 * 60  # seconds a sender may hold claimed messages before they are reclaimed
+REPORT_STAGES = ('aggregate', 'charts', 'html', 'pdf', 'deliver_requester', 'deliver_admin')
+REPORT_LOGO_PATH = "static/insight/img/innovation_company_logo.png"
+WKHTMLTOPDF_PATH = "../.local/bin/wkhtmltox/bin/wkhtmltopdf"
+RATING_PREVIEW_KEY = 'rating_preview:%s'  # cache key of a survey's ~ResponseHistogram.preview
+ADMIN_EMAIL = 'survey@survey.innovationiseasy.com'
+NOREPLY_EMAIL = 'noreply@survey.innovationiseasy.com'
 logger = logging.getLogger('django')
 
 
+def get_pdf_pool():
+    return pdf_pool.default_pool(workers=getattr(settings, 'PDF_RENDER_WORKERS', pdf_pool.DEFAULT_WORKERS),
+                                 max_queue=getattr(settings, 'PDF_RENDER_QUEUE_SIZE', pdf_pool.DEFAULT_QUEUE_SIZE),
+                                 timeout=getattr(settings, 'PDF_RENDER_TIMEOUT', pdf_pool.DEFAULT_TIMEOUT))
+
+
 class Survey(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=time_ordered_uuid, editable=False)
     requester = models.ForeignKey('auth.User')
-    survey_name = models.CharField(max_length=100, default="NA")
-    group_name = models.CharField(max_length=100)
-    created_date = models.DateTimeField(auto_now_add=True)
+    survey_name = models.CharField(max_length=100, default="NA", db_index=True)
+    group_name = models.CharField(max_length=100, db_index=True)
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
     closed = models.BooleanField(default=False)
+    closed_date = models.DateTimeField(null=True, blank=True)
+    # Maintained by ~SurveyResponse.start and ~SurveyResponse.submit, see ~Survey.recount
+    started_count = models.PositiveIntegerField(default=0)
+    submitted_count = models.PositiveIntegerField(default=0)
 
     def close(self):
         self.closed = True
-        self.save()
+        self.closed_date = timezone.now()
+        self.save(update_fields=['closed', 'closed_date'])
 
     def open(self):
         self.closed = False
-        self.save()
+        self.closed_date = None
+        self.save(update_fields=['closed', 'closed_date'])
 
     def send_link(self, domain):
         # content = render_to_string('main/email_survey_link.html', {'group_name': self.group_name,
@@ -45,60 +71,587 @@ class Survey(models.Model):
         html_content = render_to_string('main/email_survey_link.html', {'group_name': self.group_name,
                                                                         'survey_pk': self.pk,
                                                                         'domain': domain})
-        message = EmailMultiAlternatives(subject="Here is your I3™ Survey Link from The Innovation Company",
-                                         body=text_content,
-                                         to=(self.requester.email,))
-        message.attach_alternative(html_content, "text/html")
-        message.send()
-
-    def send_report(self):
-        result = False
-        reportName = 'I3 Assessment Report - %s.pdf' % self.group_name
-        responses = [[r.question_1, r.question_2, r.question_3]
-                     for r in SurveyResponse.objects.filter(survey=self.id, submitted=True)]
-        requesterName = "%s %s" % (self.requester.first_name, self.requester.last_name)
-
-        if len(responses) >= MIN_RESPONSES:
-            rating, score = get_rating(responses)
-            for i in range(MAX_REPORT_ATTEMPTS):
-                try:
-                    srMaker = SurveyReportMaker(responses, requesterName, rating)
-                    srMaker.make_plots()
-                    htmlReport = srMaker.make_html_page(os.path.join(os.getcwd(), "static/insight/img/innovation_company_logo.png"))
-                    pdf = srMaker.write_to_pdf(htmlReport,
-                                               config=pdfkit.configuration(wkhtmltopdf="../.local/bin/wkhtmltox/bin/wkhtmltopdf"))
-                    text_content = render_to_string('main/email_report_body.html', {'name': self.requester.first_name})
-                    message = EmailMessage(subject="Your I3™ Assessment Report from The Innovation Company",
-                                           body=text_content,
-                                           to=(self.requester.email,))
-                    message.attach(reportName, pdf, 'application/pdf')
-                    message.send()
-                    # Send email to survey@survey.innovationiseasy.com notifying of report generation, including a copy
-                    message.subject = 'A report has been emailed to {} {}'.format(self.requester.first_name, self.requester.last_name)
-                    message.to = ['survey@survey.innovationiseasy.com']
-                    message.from_email = 'noreply@survey.innovationiseasy.com'
-                    message.send()
-                    result = True
-                    break
-                except Exception as e:
-                    logger.error("FAILED TO CREATE REPORT: %s" % e)
-                    if i >= MAX_REPORT_ATTEMPTS - 1:
-                        send_mail(subject="FAILED TO CREATE REPORT %s TIMES" % MAX_REPORT_ATTEMPTS,
-                                  message="There was an issue trying to create a report:\n\n%s" % e,
-                                  from_email='noreply@survey.innovationiseasy.com',
-                                  recipient_list=["survey@survey.innovationiseasy.com"])
-                    else:
-                        sleep((i + 1) * 120)
-        return result
+        OutboxMessage.queue(subject="Here is your I3™ Survey Link from The Innovation Company",
+                            body=text_content,
+                            to=(self.requester.email,),
+                            html_body=html_content)
+
+    def recount(self):
+        """Recomputes the response counters from the survey's responses."""
+        responses = SurveyResponse.objects.filter(survey_id=self.pk)
+        self.started_count = responses.count()
+        self.submitted_count = responses.filter(submitted=True).count()
+        Survey.objects.filter(pk=self.pk).update(started_count=self.started_count,
+                                                 submitted_count=self.submitted_count)
+
+    def response_version(self):
+        """Returns the version of the survey's set of submitted responses, see ~ResponseHistogram"""
+        version = ResponseHistogram.objects.filter(survey_id=self.pk).values_list('version', flat=True).first()
+        if version is None:
+            version = ResponseHistogram.rebuild(self.pk).version
+        return version
+
+    def response_counts(self):
+        """Returns the 24-bin histogram of submitted responses, see ~ResponseHistogram"""
+        try:
+            return self.histogram.counts()
+        except ResponseHistogram.DoesNotExist:
+            return ResponseHistogram.rebuild(self.pk).counts()
 
     def __str__(self):
         return str(self.id)
 
 
 class SurveyResponse(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=time_ordered_uuid, editable=False)
     survey = models.ForeignKey(Survey)
     submitted = models.BooleanField(default=False)
     question_1 = models.CharField(max_length=10)
     question_2 = models.CharField(max_length=1)
     question_3 = models.CharField(max_length=1)
+    submitted_date = models.DateTimeField(null=True, blank=True, db_index=True)
+    # ~score_innovation.encode_response of the three answers, set on submission
+    response_code = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    @staticmethod
+    def encode(question_1, question_2, question_3):
+        """Returns the response code of the answers, or None if they are incomplete or invalid."""
+        try:
+            return encode_response(question_1, question_2, question_3)
+        except ValueError:
+            return None
+
+    def answers(self):
+        """Returns the [question_1, question_2, question_3] answers, decoded from the response code if set."""
+        if self.response_code is not None:
+            return decode_response(self.response_code)
+        return [self.question_1, self.question_2, self.question_3]
+
+    def start(self):
+        """Saves a new response and counts it as started on its survey."""
+        with transaction.atomic():
+            self.save()
+            Survey.objects.filter(pk=self.survey_id).update(started_count=F('started_count') + 1)
+
+    @classmethod
+    def create_submitted(cls, survey_id, question_1, question_2, question_3):
+        """Saves a complete response in one write and counts it as started and submitted."""
+        with transaction.atomic():
+            response = cls.objects.create(survey_id=survey_id, submitted=True, submitted_date=timezone.now(),
+                                          question_1=question_1, question_2=question_2, question_3=question_3,
+                                          response_code=cls.encode(question_1, question_2, question_3))
+            Survey.objects.filter(pk=survey_id).update(started_count=F('started_count') + 1,
+                                                       submitted_count=F('submitted_count') + 1)
+            ResponseHistogram.record(survey_id, question_1, question_2, question_3)
+        return response
+
+    def submit(self):
+        """Marks the response as submitted and counts it in the survey's counters and histogram.
+
+        Returns:
+            (bool): False if the response had already been submitted.
+        """
+        with transaction.atomic():
+            now = timezone.now()
+            self.response_code = self.encode(self.question_1, self.question_2, self.question_3)
+            submitted = SurveyResponse.objects.filter(pk=self.pk, submitted=False) \
+                .update(submitted=True, submitted_date=now, question_1=self.question_1,
+                        question_2=self.question_2, question_3=self.question_3, response_code=self.response_code)
+            self.submitted = True
+            self.submitted_date = now
+            if not submitted:
+                return False
+            Survey.objects.filter(pk=self.survey_id).update(submitted_count=F('submitted_count') + 1)
+            ResponseHistogram.record(self.survey_id, self.question_1, self.question_2, self.question_3)
+        return True
+
+
+HISTOGRAM_FIELDS = tuple('%s_%s_%s' % (role.lower(), risk, failure)
+                         for role in ROLES for risk in RISK_ANSWERS for failure in FAILURE_ANSWERS)
+
+
+class ResponseHistogram(models.Model):
+    """Counts of a survey's submitted responses for each (role, risk, failure) answer.
+
+    Fields are named `<role>_<risk>_<failure>` and ordered by response code, see
+    ~score_innovation.encode_response.
+    """
+    survey = models.OneToOneField(Survey, primary_key=True, related_name='histogram')
+    mgr_a_a = models.PositiveIntegerField(default=0)
+    mgr_a_b = models.PositiveIntegerField(default=0)
+    mgr_a_c = models.PositiveIntegerField(default=0)
+    mgr_b_a = models.PositiveIntegerField(default=0)
+    mgr_b_b = models.PositiveIntegerField(default=0)
+    mgr_b_c = models.PositiveIntegerField(default=0)
+    mgr_c_a = models.PositiveIntegerField(default=0)
+    mgr_c_b = models.PositiveIntegerField(default=0)
+    mgr_c_c = models.PositiveIntegerField(default=0)
+    mgr_d_a = models.PositiveIntegerField(default=0)
+    mgr_d_b = models.PositiveIntegerField(default=0)
+    mgr_d_c = models.PositiveIntegerField(default=0)
+    assoc_a_a = models.PositiveIntegerField(default=0)
+    assoc_a_b = models.PositiveIntegerField(default=0)
+    assoc_a_c = models.PositiveIntegerField(default=0)
+    assoc_b_a = models.PositiveIntegerField(default=0)
+    assoc_b_b = models.PositiveIntegerField(default=0)
+    assoc_b_c = models.PositiveIntegerField(default=0)
+    assoc_c_a = models.PositiveIntegerField(default=0)
+    assoc_c_b = models.PositiveIntegerField(default=0)
+    assoc_c_c = models.PositiveIntegerField(default=0)
+    assoc_d_a = models.PositiveIntegerField(default=0)
+    assoc_d_b = models.PositiveIntegerField(default=0)
+    assoc_d_c = models.PositiveIntegerField(default=0)
+    # Incremented whenever the counts change; identifies the survey's response set
+    version = models.PositiveIntegerField(default=0)
+
+    def counts(self):
+        return [getattr(self, field) for field in HISTOGRAM_FIELDS]
+
+    @property
+    def total(self):
+        return sum(self.counts())
+
+    def rating(self):
+        return get_rating_from_counts(self.counts())
+
+    def preview(self):
+        """Returns the live counts, score and rating shown to the survey's owner while it is open."""
+        counts = self.counts()
+        rating, score = get_rating_from_counts(counts)
+        return {'version': self.version, 'responses': sum(counts),
+                'managers': sum(counts[:N_MGR_COMBINATIONS]), 'associates': sum(counts[N_MGR_COMBINATIONS:]),
+                'score': round(score, 2), 'rating': rating, 'min_responses': MIN_RESPONSES}
+
+    @staticmethod
+    def _changed(survey_id):
+        # Drop the cached preview once the new counts are visible to other connections
+        key = RATING_PREVIEW_KEY % uuid.UUID(str(survey_id))
+        transaction.on_commit(lambda: cache.delete(key))
+
+    @classmethod
+    def record(cls, survey_id, question_1, question_2, question_3):
+        """Atomically counts one submitted response, see ~ResponseHistogram.record_many"""
+        cls.record_many(survey_id, [(question_1, question_2, question_3)])
+
+    @classmethod
+    def record_many(cls, survey_id, answers):
+        """Atomically counts submitted responses already saved for a survey.
+
+        The histogram is rebuilt from the raw responses (including the ones
+        being recorded) if the survey does not have one yet.
+
+        Args:
+            survey_id (uuid): The survey responded to.
+            answers (iterable of (str, str, str)): question_1, question_2 and
+                question_3 of each response.
+        """
+        increments = {}
+        for question_1, question_2, question_3 in answers:
+            try:
+                field = HISTOGRAM_FIELDS[encode_response(question_1, question_2, question_3)]
+            except ValueError:
+                logger.warning("Response to survey %s has invalid answers %s/%s/%s; not counted"
+                               % (survey_id, question_1, question_2, question_3))
+                continue
+            increments[field] = increments.get(field, 0) + 1
+        if not increments:
+            return
+        update = {field: F(field) + n for field, n in increments.items()}
+        update['version'] = F('version') + 1
+        with transaction.atomic():
+            cls._changed(survey_id)
+            if cls.objects.filter(survey_id=survey_id).update(**update):
+                return
+            try:
+                with transaction.atomic():
+                    cls.rebuild(survey_id, create_only=True)
+            except IntegrityError:
+                # Created concurrently by another submission; count ours on top of it
+                cls.objects.filter(survey_id=survey_id).update(**update)
+
+    @classmethod
+    def rebuild(cls, survey_id, create_only=False):
+        """Recomputes a survey's histogram from its submitted responses."""
+        counts = dict.fromkeys(HISTOGRAM_FIELDS, 0)
+        submitted = SurveyResponse.objects.filter(survey_id=survey_id, submitted=True)
+        for row in submitted.filter(response_code__isnull=False).values('response_code') \
+                .annotate(n=Count('id')).order_by():
+            counts[HISTOGRAM_FIELDS[row['response_code']]] += row['n']
+        # Responses saved before response codes existed, until backfill_response_codes has run
+        rows = (submitted.filter(response_code__isnull=True)
+                .values('question_1', 'question_2', 'question_3')
+                .annotate(n=Count('id')).order_by())
+        for row in rows:
+            try:
+                code = encode_response(row['question_1'], row['question_2'], row['question_3'])
+            except ValueError:
+                continue
+            counts[HISTOGRAM_FIELDS[code]] += row['n']
+        if create_only:
+            return cls.objects.create(survey_id=survey_id, version=sum(counts.values()), **counts)
+        with transaction.atomic():
+            histogram, created = cls.objects.select_for_update().get_or_create(
+                survey_id=survey_id, defaults=dict(counts, version=sum(counts.values())))
+            if not created and histogram.counts() != [counts[field] for field in HISTOGRAM_FIELDS]:
+                for field, count in counts.items():
+                    setattr(histogram, field, count)
+                histogram.version += 1
+                histogram.save()
+                cls._changed(survey_id)
+        return histogram
+
+
+class ReportLeaseLost(Exception):
+    pass
+
+
+class ReportJob(models.Model):
+    """A queued report generation for a survey, run by the `run_report_worker` command.
+
+    The report is made in the stages of REPORT_STAGES, each checkpointed on the
+    job so that a retry resumes at the first incomplete stage.
+
+    There is one job per survey and response set version, so repeated requests
+    for the same report attach to the same job. A worker on any node must hold
+    the job's lease, stored in the shared database, to run it.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    survey = models.ForeignKey(Survey, related_name='report_jobs')
+    response_version = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    claimed_date = models.DateTimeField(null=True, blank=True)
+    lease_owner = models.CharField(max_length=32, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    finished_date = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # Checkpoints: the last completed stage of REPORT_STAGES and the artifact of each stage
+    stage = models.CharField(max_length=20, blank=True)
+    aggregate = models.TextField(blank=True)
+    charts = models.TextField(blank=True)
+    html = models.TextField(blank=True)
+    pdf = models.BinaryField(null=True, blank=True)
+    report_attachment = models.ForeignKey('OutboxAttachment', null=True, blank=True)
+    requester_sent_date = models.DateTimeField(null=True, blank=True)
+    admin_sent_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('status', 'run_after')]
+        unique_together = [('survey', 'response_version')]
+
+    @classmethod
+    def enqueue(cls, survey):
+        """Returns the job for the survey's current responses, creating it if needed.
+
+        A job that already failed MAX_REPORT_ATTEMPTS times is queued again,
+        with a fresh set of attempts, resuming after its last completed stage.
+        In buffered ingestion mode the response log is flushed first, so the job
+        is keyed on the version its aggregate stage will read, and closing the
+        survey again with no new responses finds the same job.
+        """
+        from . import ingest
+        if ingest.buffered():
+            ingest.flush_responses()
+        version = survey.response_version()
+        try:
+            with transaction.atomic():
+                return cls.objects.create(survey=survey, response_version=version)
+        except IntegrityError:
+            job = cls.objects.get(survey=survey, response_version=version)
+        if job.status == cls.FAILED and cls.objects.filter(pk=job.pk, status=cls.FAILED) \
+                .update(status=cls.PENDING, attempts=0, run_after=timezone.now(), finished_date=None):
+            job.refresh_from_db()
+        return job
+
+    @classmethod
+    def _due(cls, now):
+        return Q(status=cls.PENDING, run_after__lte=now) | Q(status=cls.RUNNING, lease_expires__lt=now)
+
+    def claim(self):
+        """Takes the lease on this job if it is due or its previous lease expired.
+
+        Claiming is a conditional UPDATE, so workers on any number of nodes
+        never run the same job at once.
+
+        Returns:
+            (bool): True if this worker now holds the lease.
+        """
+        now = timezone.now()
+        owner = uuid.uuid4().hex
+        claimed = ReportJob.objects.filter(self._due(now), pk=self.pk) \
+            .update(status=self.RUNNING, claimed_date=now, attempts=F('attempts') + 1, lease_owner=owner,
+                    lease_expires=now + timedelta(seconds=REPORT_LEASE_SECONDS))
+        self.refresh_from_db()
+        return bool(claimed)
+
+    @classmethod
+    def claim_next(cls):
+        """Claims the next due job, or a running job whose lease expired.
+
+        Returns:
+            (~ReportJob): The claimed job, or None if no job is due.
+        """
+        for job in cls.objects.filter(cls._due(timezone.now())).order_by('run_after')[:10]:
+            if job.claim():
+                return job
+        return None
+
+    def renew_lease(self):
+        """Extends the lease before a stage runs.
+
+        Raises:
+            ReportLeaseLost: If another worker took over the job.
+        """
+        expires = timezone.now() + timedelta(seconds=REPORT_LEASE_SECONDS)
+        if not ReportJob.objects.filter(pk=self.pk, lease_owner=self.lease_owner).update(lease_expires=expires):
+            raise ReportLeaseLost("Report job %s was taken over by another worker" % self.pk)
+        self.lease_expires = expires
+
+    def run(self):
+        """Makes one attempt at the report, scheduling a retry if it fails.
+
+        Returns:
+            (bool): True if the job is finished, successfully or not.
+        """
+        try:
+            self.run_stages()
+        except ReportLeaseLost as e:
+            logger.error("ABANDONED REPORT: %s" % e)
+            return False
+        except Exception as e:
+            logger.error("FAILED TO CREATE REPORT AT STAGE %s: %s" % (self.next_stage(), e))
+            try:
+                self.renew_lease()
+            except ReportLeaseLost:
+                return False
+            self.last_error = str(e)
+            if self.attempts >= MAX_REPORT_ATTEMPTS:
+                self.status = self.FAILED
+                self.finished_date = timezone.now()
+                OutboxMessage.queue(subject="FAILED TO CREATE REPORT %s TIMES" % MAX_REPORT_ATTEMPTS,
+                                    body="There was an issue trying to create a report:\n\n%s" % e,
+                                    from_email=NOREPLY_EMAIL,
+                                    to=[ADMIN_EMAIL])
+            else:
+                self.status = self.PENDING
+                self.run_after = timezone.now() + timedelta(seconds=self.attempts * REPORT_RETRY_DELAY)
+            self.save()
+            return self.status == self.FAILED
+        return True
+
+    def next_stage(self):
+        """Returns the first stage not completed yet, or None if all are."""
+        done = REPORT_STAGES.index(self.stage) + 1 if self.stage else 0
+        return REPORT_STAGES[done] if done < len(REPORT_STAGES) else None
+
+    def run_stages(self):
+        """Runs the report stages, resuming after the last completed one.
+
+        Each stage stores its artifact and is saved before the next starts,
+        so a retry never repeats finished work or re-sends an email.
+
+        Returns:
+            (bool): False if the survey has fewer than MIN_RESPONSES responses.
+        """
+        while self.next_stage() is not None:
+            stage = self.next_stage()
+            self.renew_lease()
+            if stage.startswith('deliver_'):
+                self._run_delivery(stage)
+            elif self._run_stage(stage) is False:
+                self.status = self.DONE
+                self.finished_date = timezone.now()
+                self.last_error = "Fewer than %d responses; no report sent." % MIN_RESPONSES
+                self.save()
+                return False
+        self.status = self.DONE
+        self.finished_date = timezone.now()
+        self.save()
+        return True
+
+    def _run_stage(self, stage):
+        if getattr(self, '_' + stage)() is False:
+            return False
+        self.stage = stage
+        self.renew_lease()
+        self.save()
+
+    def _run_delivery(self, stage):
+        # The email is queued and the stage checkpointed in one transaction, so a crash or a
+        # lost lease between the two never leaves an email queued for a stage a retry repeats
+        before = (self.stage, self.report_attachment, self.requester_sent_date, self.admin_sent_date)
+        try:
+            with transaction.atomic():
+                self._run_stage(stage)
+        except Exception:
+            # Nothing was committed; do not save the send as done when the failure is recorded
+            self.stage, self.report_attachment, self.requester_sent_date, self.admin_sent_date = before
+            raise
+
+    def _report_maker(self):
+        aggregate = json.loads(self.aggregate)
+        requester = self.survey.requester
+        return SurveyReportMaker.from_counts(aggregate['counts'], "%s %s" % (requester.first_name, requester.last_name),
+                                             aggregate['rating'], in_memory=True)
+
+    def _aggregate(self):
+        from . import ingest
+        if ingest.buffered():
+            # Save submissions still in this node's response log so the report counts them
+            ingest.flush_responses()
+        # The job is keyed on the version when it was queued, but responses may have arrived since;
+        # record the version the counts were actually read at
+        histogram = ResponseHistogram.objects.filter(survey_id=self.survey_id).first() or \
+            ResponseHistogram.rebuild(self.survey_id)
+        counts = histogram.counts()
+        if sum(counts) < MIN_RESPONSES:
+            return False
+        if histogram.version != self.response_version:
+            logger.info("Report job %s for response version %d reports version %d"
+                        % (self.pk, self.response_version, histogram.version))
+        rating, score = get_rating_from_counts(counts)
+        self.aggregate = json.dumps({'counts': counts, 'rating': rating, 'score': score,
+                                     'response_version': histogram.version})
+
+    def _charts(self):
+        srMaker = self._report_maker()
+        try:
+            srMaker.make_plots()
+            self.charts = json.dumps({
+                'images': {name: base64.b64encode(getattr(srMaker, name).getvalue()).decode('ascii')
+                           for name in CHART_NAMES},
+                'mimetypes': srMaker.chart_mimetypes,
+            })
+        finally:
+            srMaker.close_charts()
+
+    def _html(self):
+        srMaker = self._report_maker()
+        charts = json.loads(self.charts)
+        if 'images' not in charts:
+            # Checkpointed before chart mimetypes were stored; those are the default backend's
+            charts = {'images': charts, 'mimetypes': None}
+        srMaker.load_charts({name: base64.b64decode(image) for name, image in charts['images'].items()},
+                            charts['mimetypes'])
+        self.html = srMaker.make_html_page(os.path.join(os.getcwd(), REPORT_LOGO_PATH))
+
+    def _pdf(self):
+        import pdfkit
+        self.pdf = self._report_maker().write_to_pdf(self.html,
+                                                     config=pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH),
+                                                     pool=get_pdf_pool(),
+                                                     engine=getattr(settings, 'REPORT_PDF_ENGINE', 'wkhtmltopdf'))
+
+    def _report_attachment(self):
+        if self.report_attachment_id is None:
+            self.report_attachment = OutboxAttachment.objects.create(
+                filename='I3 Assessment Report - %s.pdf' % self.survey.group_name,
+                mimetype='application/pdf',
+                content=bytes(self.pdf))
+        return self.report_attachment
+
+    def resend(self):
+        """Queues the finished report to the requester again, eg. when they ask for it on demand.
+
+        Returns:
+            (bool): False if the job is not done or did not make a report.
+        """
+        if self.status != self.DONE or self.report_attachment_id is None:
+            return False
+        self._queue_requester_email()
+        return True
+
+    def _queue_requester_email(self):
+        requester = self.survey.requester
+        OutboxMessage.queue(subject="Your I3™ Assessment Report from The Innovation Company",
+                            body=render_to_string('main/email_report_body.html', {'name': requester.first_name}),
+                            to=(requester.email,),
+                            attachment=self._report_attachment())
+
+    def _deliver_requester(self):
+        if self.requester_sent_date is None:
+            self._queue_requester_email()
+            self.requester_sent_date = timezone.now()
+
+    def _deliver_admin(self):
+        # Send email to survey@survey.innovationiseasy.com notifying of report generation, including a copy
+        if self.admin_sent_date is None:
+            requester = self.survey.requester
+            OutboxMessage.queue(subject='A report has been emailed to {} {}'.format(requester.first_name,
+                                                                                   requester.last_name),
+                                body=render_to_string('main/email_report_body.html', {'name': requester.first_name}),
+                                to=[ADMIN_EMAIL],
+                                from_email=NOREPLY_EMAIL,
+                                attachment=self._report_attachment())
+            self.admin_sent_date = timezone.now()
+
+    def __str__(self):
+        return "%s (%s)" % (self.survey_id, self.status)
+
+
+class OutboxAttachment(models.Model):
+    """A file attached to one or more ~OutboxMessage rows; its MIME part is built once per batch."""
+    filename = models.CharField(max_length=255)
+    mimetype = models.CharField(max_length=100)
+    content = models.BinaryField()
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.filename
+
+
+class OutboxMessage(models.Model):
+    """An outgoing email, queued by the request path and sent by the `send_outbox` command."""
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (SENDING, 'Sending'), (SENT, 'Sent'), (FAILED, 'Failed'))
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254, blank=True)
+    to = models.TextField(help_text="JSON list of recipient addresses")
+    attachment = models.ForeignKey(OutboxAttachment, null=True, blank=True, related_name='messages')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_date = models.DateTimeField(auto_now_add=True)
+    claimed_date = models.DateTimeField(null=True, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    sent_date = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    @classmethod
+    def queue(cls, subject, body, to, from_email=None, html_body='', attachment=None):
+        """Queues an email; it is sent by ~outbox.flush_outbox.
+
+        Args:
+            subject (str): Subject line.
+            body (str): Plain text body.
+            to (list of str): Recipient addresses.
+            from_email (str, optional): Sender; defaults to DEFAULT_FROM_EMAIL.
+            html_body (str, optional): HTML alternative of the body.
+            attachment (~OutboxAttachment, optional): Attached file, which may
+                be shared with other messages.
+        """
+        return cls.objects.create(subject=subject, body=body, html_body=html_body, from_email=from_email or '',
+                                  to=json.dumps(list(to)), attachment=attachment)
+
+    @classmethod
+    def _claimable(cls, now):
+        # Messages left SENDING by a sender that crashed or was killed are reclaimed once their lease expires
+        return Q(status=cls.PENDING) | Q(status=cls.SENDING, lease_expires__lt=now)
+
+    def recipients(self):
+        return json.loads(self.to)
+
+    def __str__(self):
+        return "%s (%s)" % (self.subject, self.status)
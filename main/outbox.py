@@ -0,0 +1,127 @@
+"""Sends queued ~models.OutboxMessage emails in batches over one SMTP connection."""
+import logging
+
+from datetime import timedelta
+from email import encoders
+from email.mime.base import MIMEBase
+
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.utils import timezone
+
+from .models import OutboxMessage, OUTBOX_LEASE_SECONDS
+
+
+MAX_SEND_ATTEMPTS = 5
+logger = logging.getLogger('django')
+
+
+def _mime_part(attachment):
+    """Encodes an ~models.OutboxAttachment once so every message in a batch can attach the same part."""
+    maintype, subtype = attachment.mimetype.split('/', 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(bytes(attachment.content))
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment', filename=attachment.filename)
+    return part
+
+
+def _build_message(outgoing, mime_parts, connection):
+    if outgoing.html_body:
+        message = EmailMultiAlternatives(subject=outgoing.subject, body=outgoing.body,
+                                         from_email=outgoing.from_email or None,
+                                         to=outgoing.recipients(), connection=connection)
+        message.attach_alternative(outgoing.html_body, "text/html")
+    else:
+        message = EmailMessage(subject=outgoing.subject, body=outgoing.body,
+                               from_email=outgoing.from_email or None,
+                               to=outgoing.recipients(), connection=connection)
+    if outgoing.attachment_id is not None:
+        if outgoing.attachment_id not in mime_parts:
+            mime_parts[outgoing.attachment_id] = _mime_part(outgoing.attachment)
+        message.attach(mime_parts[outgoing.attachment_id])
+    return message
+
+
+def _claim_batch(batch_size):
+    """Leases up to `batch_size` pending messages, or ones whose previous sender's lease expired.
+
+    A message reclaimed from a sender that died mid-batch may already have
+    been handed to the SMTP server, so delivery is at least once.
+    """
+    now = timezone.now()
+    candidates = list(OutboxMessage.objects.filter(OutboxMessage._claimable(now))
+                      .order_by('created_date').values_list('pk', 'status')[:batch_size])
+    claimed = []
+    for pk, status in candidates:
+        if OutboxMessage.objects.filter(OutboxMessage._claimable(now), pk=pk).update(
+                status=OutboxMessage.SENDING, claimed_date=now,
+                lease_expires=now + timedelta(seconds=OUTBOX_LEASE_SECONDS)):
+            if status == OutboxMessage.SENDING:
+                logger.warning("Reclaimed email %s from a sender whose lease expired" % pk)
+            claimed.append(pk)
+    return list(OutboxMessage.objects.filter(pk__in=claimed).select_related('attachment').order_by('created_date'))
+
+
+def _release(messages):
+    """Puts claimed messages that were not attempted back in the queue."""
+    OutboxMessage.objects.filter(pk__in=[outgoing.pk for outgoing in messages], status=OutboxMessage.SENDING) \
+        .update(status=OutboxMessage.PENDING, lease_expires=None)
+
+
+def flush_outbox(batch_size=50):
+    """Sends all pending messages, `batch_size` at a time, over a single connection.
+
+    Messages sharing an attachment reuse one encoded MIME part. A message that
+    fails is retried on the next flush, up to MAX_SEND_ATTEMPTS times. If the
+    connection cannot be reopened after a failure, the rest of the batch is
+    put back in the queue and the flush stops. If the connection cannot be
+    opened at all, nothing is claimed and the error is raised to the caller.
+
+    Returns:
+        (2-tuple of int): Number of messages sent and number that failed.
+    """
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        logger.error("FAILED TO OPEN EMAIL CONNECTION: %s" % e)
+        raise
+    try:
+        while True:
+            batch = _claim_batch(batch_size)
+            if not batch:
+                break
+            mime_parts = {}
+            for i, outgoing in enumerate(batch):
+                reopened = True
+                outgoing.attempts += 1
+                try:
+                    _build_message(outgoing, mime_parts, connection).send()
+                except Exception as e:
+                    logger.error("FAILED TO SEND EMAIL %s: %s" % (outgoing.pk, e))
+                    outgoing.last_error = str(e)
+                    outgoing.status = OutboxMessage.FAILED if outgoing.attempts >= MAX_SEND_ATTEMPTS \
+                        else OutboxMessage.PENDING
+                    failed += 1
+                    # The connection may be broken; reopen it for the rest of the batch
+                    connection.close()
+                    try:
+                        connection.open()
+                    except Exception as e:
+                        logger.error("FAILED TO REOPEN EMAIL CONNECTION: %s" % e)
+                        reopened = False
+                else:
+                    outgoing.status = OutboxMessage.SENT
+                    outgoing.sent_date = timezone.now()
+                    sent += 1
+                outgoing.lease_expires = None
+                outgoing.save(update_fields=['status', 'attempts', 'sent_date', 'last_error', 'lease_expires'])
+                if not reopened:
+                    _release(batch[i + 1:])
+                    break
+            if failed:
+                break
+    finally:
+        connection.close()
+    return sent, failed
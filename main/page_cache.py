@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for serving the survey question pages from a rendered-page cache
+
+Question pages with an unbound form are the same for every respondent of
+every survey except for the CSRF token and the form action URL. They are
+rendered once per template version and Site with placeholders in those two
+places, kept in the Django cache, and each request only splices in its own
+token and URL.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import get_template
+from django.utils.html import escape
+
+
+CSRF_PLACEHOLDER = 'csrf-token-placeholder-7d1e04'
+ACTION_PLACEHOLDER = 'form-action-placeholder-7d1e04'
+BASE_TEMPLATE = 'base.html'
+
+_template_versions = {}
+
+
+def template_version(template_name):
+    """Returns a hash of the page template and the base template it extends."""
+    if template_name not in _template_versions or settings.DEBUG:
+        sha = hashlib.sha1()
+        for name in (template_name, BASE_TEMPLATE):
+            sha.update(get_template(name).template.source.encode('utf-8'))
+        _template_versions[template_name] = sha.hexdigest()[:16]
+    return _template_versions[template_name]
+
+
+def render_question_page(request, template_name, form_class):
+    """Returns the page of an unbound question form for this request.
+
+    Args:
+        request (~django.http.HttpRequest): The request; its CSRF token and
+            path are spliced into the cached page.
+        template_name (str): Template rendering `form` and `action`.
+        form_class (type): Form class instantiated without data.
+
+    Returns:
+        (~django.http.HttpResponse): The page.
+    """
+    key = 'question_page:%s:%s:%s' % (template_name, template_version(template_name),
+                                      Site.objects.get_current().domain)
+    page = cache.get(key)
+    if page is None:
+        page = get_template(template_name).render({'form': form_class(), 'csrf_token': CSRF_PLACEHOLDER,
+                                                   'action': ACTION_PLACEHOLDER})
+        cache.set(key, page, None)
+    page = page.replace(CSRF_PLACEHOLDER, get_token(request), 1) \
+        .replace(ACTION_PLACEHOLDER, escape(request.get_full_path()), 1)
+    return HttpResponse(page)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for rendering Innovation Company report PDFs on a worker pool
+
+A fixed number of long-lived worker threads take HTML render jobs from a
+bounded queue and convert them with `wkhtmltopdf`. This caps the number of
+WebKit processes running at once when many surveys close together, enforces a
+timeout on every job, and keeps queue depth and render time statistics.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+import queue
+import subprocess
+import threading
+import time
+
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_TIMEOUT = 120
+
+
+class PdfRenderTimeout(Exception):
+    pass
+
+
+class PdfQueueFull(Exception):
+    pass
+
+
+class PdfJob(object):
+    def __init__(self, html, config, options, timeout):
+        """A queued PDF render job; see ~PdfRenderPool.submit."""
+        self.html = html
+        self.config = config
+        self.options = options
+        self.timeout = timeout
+        self.submitted = time.time()
+        self._done = threading.Event()
+        self._pdf = None
+        self._error = None
+
+    def _finish(self, pdf=None, error=None):
+        self._pdf = pdf
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the job and returns the PDF bytes.
+
+        Raises:
+            PdfRenderTimeout: If the job did not finish within `timeout`
+                seconds, or `wkhtmltopdf` exceeded the job timeout.
+            IOError: If `wkhtmltopdf` reported an error.
+        """
+        if not self._done.wait(timeout):
+            raise PdfRenderTimeout("PDF job still pending after %s seconds" % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._pdf
+
+
+def render_pdf(html, config=None, options=None, timeout=DEFAULT_TIMEOUT):
+    """Runs `wkhtmltopdf` on an HTML string, killing it after `timeout` seconds.
+
+    Returns:
+        (bytes): The rendered PDF.
+    """
+    import pdfkit
+    kit = pdfkit.PDFKit(html, 'string', configuration=config, options=options)
+    proc = subprocess.Popen(kit.command(), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        pdf, stderr = proc.communicate(input=html.encode('utf-8'), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise PdfRenderTimeout("wkhtmltopdf did not finish within %s seconds" % timeout)
+    stderr = stderr.decode('utf-8', 'replace')
+    if 'Error' in stderr:
+        raise IOError("wkhtmltopdf reported an error:\n" + stderr)
+    if proc.returncode != 0:
+        raise IOError("wkhtmltopdf exited with non-zero code %s. error:\n%s" % (proc.returncode, stderr))
+    return pdf
+
+
+class PdfRenderPool(object):
+    def __init__(self, workers=DEFAULT_WORKERS, max_queue=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_TIMEOUT):
+        """Pool of worker threads converting HTML reports to PDF.
+
+        Args:
+            workers (int): Number of worker threads, ie. the maximum number of
+                `wkhtmltopdf` processes running at once.
+            max_queue (int): Maximum number of jobs waiting for a worker.
+            timeout (int): Default per-job timeout, in seconds.
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.render_seconds = 0.0
+        self.max_render_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="pdf-render-%d" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            started = time.time()
+            with self._lock:
+                self.busy += 1
+                self.wait_seconds += started - job.submitted
+            pdf = error = None
+            try:
+                pdf = render_pdf(job.html, job.config, job.options, job.timeout)
+            except Exception as e:
+                error = e
+            elapsed = time.time() - started
+            with self._lock:
+                self.busy -= 1
+                self.render_seconds += elapsed
+                self.max_render_seconds = max(self.max_render_seconds, elapsed)
+                if error is None:
+                    self.completed += 1
+                elif isinstance(error, PdfRenderTimeout):
+                    self.timed_out += 1
+                else:
+                    self.failed += 1
+            job._finish(pdf=pdf, error=error)
+            self._queue.task_done()
+
+    def submit(self, html, config=None, options=None, timeout=None, block=True):
+        """Queues an HTML report for conversion.
+
+        Args:
+            html (str): HTML markup of the report.
+            config (~pdfkit.configuration, optional): pdfkit configuration.
+            options (dict, optional): `wkhtmltopdf` options.
+            timeout (int, optional): Seconds `wkhtmltopdf` may run before it is
+                killed; defaults to the pool timeout.
+            block (bool): Wait for room in the queue if it is full. If False,
+                ~PdfQueueFull is raised instead.
+
+        Returns:
+            (~PdfJob): The queued job.
+        """
+        self._start()
+        job = PdfJob(html, config, options, self.timeout if timeout is None else timeout)
+        try:
+            self._queue.put(job, block=block)
+        except queue.Full:
+            raise PdfQueueFull("PDF render queue is full (%d jobs)" % self._queue.maxsize)
+        return job
+
+    def render(self, html, config=None, options=None, timeout=None):
+        """Submits a job and waits for its PDF bytes."""
+        return self.submit(html, config, options, timeout).result()
+
+    def stats(self):
+        """Returns queue depth and render time statistics.
+
+        Returns:
+            (dict of str => number): 'workers', 'queue_depth', 'busy',
+                'completed', 'failed', 'timed_out', 'mean_render_seconds',
+                'max_render_seconds' and 'mean_wait_seconds'.
+        """
+        with self._lock:
+            finished = self.completed + self.failed + self.timed_out
+            return {
+                'workers': len(self._threads),
+                'queue_depth': self._queue.qsize(),
+                'busy': self.busy,
+                'completed': self.completed,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+                'mean_render_seconds': self.render_seconds / finished if finished else 0.0,
+                'max_render_seconds': self.max_render_seconds,
+                'mean_wait_seconds': self.wait_seconds / finished if finished else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        """Stops the workers once the queued jobs are done."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool(**kwargs):
+    """Returns the process-wide pool, creating it with `kwargs` on first use."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = PdfRenderPool(**kwargs)
+        return _default_pool
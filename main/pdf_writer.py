@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for writing Innovation Company reports directly as PDF files
+
+Draws the fixed one-page report layout (header block, rating, 2x2 chart grid
+and footer text) straight into a PDF document in-process, from the state of a
+~survey_maker.SurveyReportMaker. Charts are drawn as vector graphics from the
+same figures the chart backends render, so neither an HTML engine nor a
+`wkhtmltopdf` subprocess is needed.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+from datetime import date
+import math
+import re
+import zlib
+
+from . import chart_renderer
+
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 36
+CHART_SCALE = 0.75  # chart pixels to PDF points
+LABEL_WIDTH = 70
+BORDER_COLOR = (0.827, 0.827, 0.827)
+GREY = (0.5, 0.5, 0.5)
+BLACK = (0, 0, 0)
+
+# Advance widths of the standard Helvetica font for ASCII 32-126, per 1000 em
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+FONTS = {'regular': ('F1', 'Helvetica'), 'bold': ('F2', 'Helvetica-Bold')}
+
+
+def text_width(text, size, bold=False):
+    """Approximate width of a Helvetica string, in points."""
+    width = sum(HELVETICA_WIDTHS[ord(c) - 32] if 32 <= ord(c) < 127 else 556 for c in text)
+    return width * size / 1000.0 * (1.05 if bold else 1.0)
+
+
+def wrap(text, size, width, bold=False):
+    """Splits text into lines no wider than `width` points."""
+    lines = []
+    line = ''
+    for word in text.split():
+        candidate = word if not line else line + ' ' + word
+        if line and text_width(candidate, size, bold) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _color(value):
+    if isinstance(value, tuple):
+        return value
+    match = re.match(r'rgb\((\d+),\s*(\d+),\s*(\d+)\)', value or '')
+    if not match:
+        return BLACK
+    return tuple(int(c) / 255.0 for c in match.groups())
+
+
+def _escape(text):
+    raw = text.encode('cp1252', 'replace')
+    return raw.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+class PdfCanvas(object):
+    def __init__(self):
+        """Accumulates drawing operators for a single PDF page.
+
+        Coordinates are in points with the origin at the top left corner of
+        the page, like ~chart_renderer.layout_chart output.
+        """
+        self.ops = []
+
+    def _y(self, y):
+        return PAGE_HEIGHT - y
+
+    def rect(self, x, y, width, height, fill=None, stroke=None):
+        if fill is not None:
+            self.ops.append('%.3f %.3f %.3f rg' % _color(fill))
+        if stroke is not None:
+            self.ops.append('%.3f %.3f %.3f RG 0.75 w' % _color(stroke))
+        op = 'B' if fill is not None and stroke is not None else ('f' if fill is not None else 'S')
+        self.ops.append('%.2f %.2f %.2f %.2f re %s' % (x, self._y(y + height), width, height, op))
+
+    def line(self, x1, y1, x2, y2, color=BORDER_COLOR):
+        self.ops.append('%.3f %.3f %.3f RG 0.75 w %.2f %.2f m %.2f %.2f l S'
+                        % (_color(color) + (x1, self._y(y1), x2, self._y(y2))))
+
+    def text(self, x, y, text, size, bold=False, anchor='start', angle=0, color=BLACK):
+        """Draws a line of text whose baseline starts, centers or ends at (x, y)."""
+        theta = math.radians(angle)
+        offset = {'start': 0, 'middle': 0.5, 'end': 1}[anchor] * text_width(text, size, bold)
+        x -= offset * math.cos(theta)
+        y += offset * math.sin(theta)
+        font = FONTS['bold' if bold else 'regular'][0]
+        cos, sin = math.cos(theta), math.sin(theta)
+        command = ('BT /%s %.2f Tf %.3f %.3f %.3f rg %.4f %.4f %.4f %.4f %.2f %.2f Tm ('
+                   % ((font, size) + _color(color) + (cos, sin, -sin, cos, x, self._y(y))))
+        self.ops.append(command.encode('ascii') + _escape(text) + b') Tj ET')
+
+    def paragraph(self, x, y, text, size, width, bold=False, leading=1.3, color=BLACK):
+        """Draws wrapped text and returns the y coordinate below it."""
+        for line in wrap(text, size, width, bold):
+            y += size * leading
+            self.text(x, y, line, size, bold=bold, color=color)
+        return y
+
+    def chart(self, x, y, figure, scale=CHART_SCALE):
+        """Draws a chart figure with its top left corner at (x, y)."""
+        chart = chart_renderer.layout_chart(figure)
+        self.rect(x, y, chart.width * scale, chart.height * scale, fill=(1, 1, 1), stroke=BORDER_COLOR)
+        for shape in chart.shapes:
+            if isinstance(shape, chart_renderer.Rect):
+                if shape.height > 0:
+                    self.rect(x + shape.x * scale, y + shape.y * scale,
+                              shape.width * scale, shape.height * scale, fill=shape.fill)
+            else:
+                self.text(x + shape.x * scale, y + shape.y * scale, shape.text, shape.size * scale,
+                          anchor=shape.anchor, angle=-shape.angle, color=shape.fill)
+
+    def content(self):
+        return b'\n'.join(op if isinstance(op, bytes) else op.encode('ascii') for op in self.ops)
+
+
+def build_document(content, title=''):
+    """Wraps a page content stream into a complete single-page PDF document.
+
+    Returns:
+        (bytes): The PDF file contents.
+    """
+    stream = zlib.compress(content)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        ('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents 6 0 R '
+         '/Resources << /Font << /F1 4 0 R /F2 5 0 R >> >> >>' % (PAGE_WIDTH, PAGE_HEIGHT)).encode('ascii'),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+        ('<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream)).encode('ascii') + stream + b'\nendstream',
+        b'<< /Title (' + _escape(title) + b') /Producer (Innovation Company report writer) >>',
+    ]
+    out = [b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    offsets = []
+    position = len(out[0])
+    for number, body in enumerate(objects, 1):
+        chunk = ('%d 0 obj\n' % number).encode('ascii') + body + b'\nendobj\n'
+        offsets.append(position)
+        out.append(chunk)
+        position += len(chunk)
+    xref = ['xref', '0 %d' % (len(objects) + 1), '0000000000 65535 f ']
+    xref.extend('%010d 00000 n ' % offset for offset in offsets)
+    out.append(('\n'.join(xref) + '\ntrailer\n<< /Size %d /Root 1 0 R /Info 7 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                % (len(objects) + 1, position)).encode('ascii'))
+    return b''.join(out)
+
+
+def write_report_pdf(report):
+    """Draws an Innovation Company report as a PDF document.
+
+    Args:
+        report (~survey_maker.SurveyReportMaker): The report whose counts,
+            rating, user name and chart figures are drawn. Charts do not need
+            to have been rendered with ~SurveyReportMaker.make_plots.
+
+    Returns:
+        (bytes): The PDF file contents.
+    """
+    canvas = PdfCanvas()
+    width = PAGE_WIDTH - 2 * MARGIN
+    y = MARGIN
+    canvas.text(MARGIN, y + 22, "The Innovation Company", 22, bold=True, color=(0.35, 0.45, 0.2))
+    y = canvas.paragraph(MARGIN, y + 36, u"Thank you for using The Innovation Company's I3™ Assessment Tool.  "
+                                         u"Below are your results.", 13, width, bold=True)
+
+    top = y + 10
+    details = ["Date of this report: " + date.today().strftime("%m/%d/%Y"),
+               "Your name: " + str(report.user_name or ""),
+               "Number of respondents: " + str(report.resp_num),
+               "Number of managers: " + str(report.resp_man),
+               "Number of associates: " + str(report.resp_asc)]
+    for i, line in enumerate(details):
+        canvas.text(MARGIN, top + 14 * (i + 1), line, 11)
+    rating_x = PAGE_WIDTH - MARGIN - 90
+    canvas.text(rating_x, top + 14, "Your I3 rating*", 11, anchor='middle')
+    canvas.text(rating_x, top + 40, str(report.rating or ""), 18, bold=True, anchor='middle')
+
+    chart_width = 300 * CHART_SCALE
+    chart_height = 240 * CHART_SCALE
+    gap = (width - LABEL_WIDTH - 2 * chart_width) / 2.0
+    left_x = MARGIN + LABEL_WIDTH
+    right_x = left_x + chart_width + 2 * gap
+    divider_x = left_x + chart_width + gap
+    y = top + 14 * len(details) + 30
+    canvas.text(left_x + chart_width / 2, y, "Level of RISK", 14, anchor='middle')
+    canvas.text(right_x + chart_width / 2, y, "Perception of FAILURE", 14, anchor='middle')
+    y += 8
+    figures = dict(report.make_figures())
+    for label, prefix in (("Overall", "overall_"), ("By manager and associate", "grouped_")):
+        canvas.paragraph(MARGIN, y + chart_height / 2 - 14, label, 10, LABEL_WIDTH - 6)
+        canvas.chart(left_x, y, figures[prefix + "risk"])
+        canvas.chart(right_x, y, figures[prefix + "failure"])
+        canvas.line(divider_x, y, divider_x, y + chart_height)
+        y += chart_height + 6
+
+    y = canvas.paragraph(MARGIN, y + 4, "*Responses were entered into The Innovation Company's proprietary I3 "
+                                        "scoring algorithm and your result is based on a HOT - WARM - COLD scale "
+                                        "where HOT is best.", 10, width)
+    y = canvas.paragraph(MARGIN, y + 6, "Next steps: Please contact us at 978-266-0012 or "
+                                        "info@innovationisEASY.com to schedule a time discuss these results and "
+                                        "explore specific action items via a free 15 minute consultation.  If you "
+                                        "would like to start some work on your own please checkout our apps, games, "
+                                        "and Innovation DIY process at http://www.innovationiseasy.com/diy.html",
+                         10, width)
+    y += 28
+    canvas.text(PAGE_WIDTH / 2.0, y, u"Thank you for using our I3™ Assessment Tool", 13,
+                bold=True, anchor='middle')
+    canvas.text(PAGE_WIDTH / 2.0, y + 18, "Copywright 2017 The Innovation Company, LLC All rights reserved.", 9,
+                anchor='middle', color=GREY)
+    canvas.text(PAGE_WIDTH / 2.0, y + 32, "www.innovationisEASY.com  info@innovationisEASY.com", 9,
+                anchor='middle', color=GREY)
+    return build_document(canvas.content(), title="I3 Assessment Report")
@@ -17,6 +17,18 @@ yosD = yosE * 3 / 4
 yosC = yosE / 2
 yosB = yosE / 4
 
+# Answer encoding: every (role, risk, failure) response maps to one of 24 codes
+ROLES = ('MGR', 'ASSOC')
+RISK_ANSWERS = ('a', 'b', 'c', 'd')
+FAILURE_ANSWERS = ('a', 'b', 'c')
+N_COMBINATIONS = len(ROLES) * len(RISK_ANSWERS) * len(FAILURE_ANSWERS)
+N_MGR_COMBINATIONS = N_COMBINATIONS // len(ROLES)
+
+RATINGS = [(90, "HOT"), (80, "HOT to WARM"), (70, "WARM"), (60, "WARM to COLD")]
+# Most the score of ~get_rating may differ from the count-based scores, which round
+# differently since they sum in another order; ample for surveys under a million responses
+SCORE_TOLERANCE = 1e-6
+
 
 def _get_score(x, y, z):
     score = ((ASSOCtoMGR if x == "ASSOC" else 1) *
@@ -30,6 +42,46 @@ def _get_score(x, y, z):
     return score
 
 
+def encode_response(x, y, z):
+    """Returns the code (0-23) of a (role, risk, failure) response."""
+    return (ROLES.index(x) * len(RISK_ANSWERS) + RISK_ANSWERS.index(y)) * len(FAILURE_ANSWERS) + \
+        FAILURE_ANSWERS.index(z)
+
+
+def decode_response(code):
+    """Returns the [role, risk, failure] response of a code (0-23)."""
+    rest, z = divmod(int(code), len(FAILURE_ANSWERS))
+    x, y = divmod(rest, len(RISK_ANSWERS))
+    return [ROLES[x], RISK_ANSWERS[y], FAILURE_ANSWERS[z]]
+
+
+_score_table = {}
+
+
+def score_table():
+    """Returns the score of each of the 24 response codes.
+
+    The table is derived from the formula parameters (`ASSOCtoMGR`, `riskB`...
+    `failC`, `YIntercept`) and rebuilt whenever any of them changes.
+
+    Returns:
+        (tuple of float): ~_get_score of each response code, see
+            ~encode_response.
+    """
+    params = (ASSOCtoMGR, riskB, riskC, riskD, failB, failC, YIntercept)
+    if _score_table.get('params') != params:
+        _score_table['table'] = tuple(_get_score(*decode_response(code)) for code in range(N_COMBINATIONS))
+        _score_table['params'] = params
+    return _score_table['table']
+
+
+def _rating(score):
+    for threshold, rating in RATINGS:
+        if score >= threshold:
+            return rating
+    return "COLD"
+
+
 def get_rating(responses):
     if len(responses) < 1:
         return "NON EXISTENT", 0
@@ -43,18 +95,104 @@ def get_rating(responses):
     assocMean = 0.0 if len(assocScores) < 1 else 1.0 * sum(assocScores) / len(assocScores)
     score = pctMgr * mgrMean + pctAssoc * assocMean + MIF * (mgrMean - YIntercept / 2.0)
 
-    if score >= 90:
-        rating = "HOT"
-    elif score >= 80:
-        rating = "HOT to WARM"
-    elif score >= 70:
-        rating = "WARM"
-    elif score >= 60:
-        rating = "WARM to COLD"
-    else:
-        rating = "COLD"
-
-    return rating, score
+    return _rating(score), score
+
+
+def get_rating_from_counts(counts):
+    """Scores a survey from its 24-bin response histogram.
+
+    Evaluates the ~get_rating formula with the precomputed ~score_table, so
+    the cost does not depend on the number of respondents. ~get_rating adds
+    up scores response by response, so its last bits depend on the order of
+    the responses; for valid responses the two scores differ by at most
+    SCORE_TOLERANCE, and the ratings agree unless the score is that close to
+    a threshold of RATINGS. ~get_ratings reproduces this function exactly.
+
+    Args:
+        counts (list of int): Number of responses of each response code,
+            see ~encode_response.
+
+    Returns:
+        (2-tuple of str, float): The rating and score, as ~get_rating.
+    """
+    table = score_table()
+    nMgr = sum(counts[:N_MGR_COMBINATIONS])
+    nAssoc = sum(counts[N_MGR_COMBINATIONS:N_COMBINATIONS])
+    total = nMgr + nAssoc
+    if total < 1:
+        return "NON EXISTENT", 0
+    mgrMean = 0.0 if nMgr < 1 else \
+        1.0 * sum(c * s for c, s in zip(counts[:N_MGR_COMBINATIONS], table[:N_MGR_COMBINATIONS])) / nMgr
+    assocMean = 0.0 if nAssoc < 1 else \
+        1.0 * sum(c * s for c, s in zip(counts[N_MGR_COMBINATIONS:], table[N_MGR_COMBINATIONS:])) / nAssoc
+    score = 1.0 * nMgr / total * mgrMean + 1.0 * nAssoc / total * assocMean + MIF * (mgrMean - YIntercept / 2.0)
+
+    return _rating(score), score
+
+
+def encode_responses(responses):
+    """Encodes a list of [role, risk, failure] responses as an array of codes."""
+    import numpy as np
+    return np.array([encode_response(x, y, z) for x, y, z in responses], dtype=np.intp)
+
+
+def counts_from_codes(codes, survey_index, n_surveys):
+    """Builds per-survey response histograms from encoded responses.
+
+    Args:
+        codes (array of int): Response codes, see ~encode_response.
+        survey_index (array of int): Index (0 to n_surveys - 1) of the survey
+            each response belongs to.
+        n_surveys (int): Number of surveys.
+
+    Returns:
+        (ndarray): An (n_surveys, 24) array of response counts.
+    """
+    import numpy as np
+    flat = np.asarray(survey_index, dtype=np.intp) * N_COMBINATIONS + np.asarray(codes, dtype=np.intp)
+    return np.bincount(flat, minlength=n_surveys * N_COMBINATIONS).reshape(n_surveys, N_COMBINATIONS)
+
+
+def get_ratings(counts):
+    """Scores many surveys at once from their response histograms.
+
+    Vectorized across surveys, but performs the same floating point
+    operations in the same order as ~get_rating_from_counts, so each score
+    is bit-identical to it, and within SCORE_TOLERANCE of ~get_rating.
+
+    Args:
+        counts (array-like): An (n_surveys, 24) array of response counts
+            indexed by response code, see ~encode_response and
+            ~counts_from_codes.
+
+    Returns:
+        (2-tuple of list of str, ndarray): The rating and score of each
+            survey, in the same form as ~get_rating_from_counts.
+    """
+    import numpy as np
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.int64))
+    table = score_table()
+    nMgr = counts[:, :N_MGR_COMBINATIONS].sum(axis=1).astype(float)
+    nAssoc = counts[:, N_MGR_COMBINATIONS:N_COMBINATIONS].sum(axis=1).astype(float)
+    total = nMgr + nAssoc
+    # Accumulate column by column, as the sequential sums of ~get_rating_from_counts do
+    mgrSum = np.zeros(len(counts))
+    for code in range(N_MGR_COMBINATIONS):
+        mgrSum = mgrSum + counts[:, code] * table[code]
+    assocSum = np.zeros(len(counts))
+    for code in range(N_MGR_COMBINATIONS, N_COMBINATIONS):
+        assocSum = assocSum + counts[:, code] * table[code]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mgrMean = np.where(nMgr > 0, 1.0 * mgrSum / nMgr, 0.0)
+        assocMean = np.where(nAssoc > 0, 1.0 * assocSum / nAssoc, 0.0)
+        score = 1.0 * nMgr / total * mgrMean + 1.0 * nAssoc / total * assocMean + MIF * (mgrMean - YIntercept / 2.0)
+    score = np.where(total > 0, score, 0.0)
+
+    ratings = np.select([score >= threshold for threshold, _ in RATINGS],
+                        [rating for _, rating in RATINGS], "COLD").astype(object)
+    ratings[total < 1] = "NON EXISTENT"
+    return ratings.tolist(), score
 
 if __name__ == "__main__":
     import pandas as pd
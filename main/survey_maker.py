@@ -10,19 +10,98 @@ Python Version: 2.7
 
 Copywright 2017 The Innovation Company, LLC All rights reserved    
 """
+import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+import io
+import mimetypes
 import os
 import tempfile
-
-import pdfkit
-import plotly.plotly as plty
-import plotly.graph_objs as gobj
+import threading
 
 import conf
+from . import chart_renderer
+from .chart_cache import CHART_CACHE
+from . import pdf_pool
+from . import pdf_writer
+from .score_innovation import decode_response
+
+LOCAL_BACKEND = 'local'
+PLOTLY_BACKEND = 'plotly'
+CHART_BACKENDS = (LOCAL_BACKEND, PLOTLY_BACKEND)
+CHART_SUFFIXES = {LOCAL_BACKEND: '.svg', PLOTLY_BACKEND: '.png'}
+CHART_MIMETYPES = {LOCAL_BACKEND: 'image/svg+xml', PLOTLY_BACKEND: 'image/png'}
+WKHTMLTOPDF_ENGINE = 'wkhtmltopdf'
+DIRECT_ENGINE = 'direct'
+PDF_ENGINES = (WKHTMLTOPDF_ENGINE, DIRECT_ENGINE)
+CHART_NAMES = ('overall_risk', 'overall_failure', 'grouped_risk', 'grouped_failure')
+
+CHART_WORKERS = 4
+
+# Chart labels of the question 2 (risk) and question 3 (failure) answers
+ANSWER_LABELS = {
+    'Risk': {
+        'a': 'High',
+        'b': 'Medium',
+        'c': 'Low',
+        'd': 'No',
+    },
+    'Failure': {
+        'a': 'Supported',
+        'b': 'Injured',
+        'c': 'Booted',
+    },
+}
+
+# Bar order of each chart, see ~SurveyReportMaker.make_figures
+CHART_KEYS = {
+    'Risk': ('High', 'Medium', 'Low', 'No'),
+    'Failure': ('Supported', 'Injured', 'Booted'),
+}
+
+_data_uris = {}
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ChartRenderError(Exception):
+    def __init__(self, errors):
+        """Raised when one or more report charts could not be rendered.
+
+        Args:
+            errors (dict of str => Exception): The error of each failed
+                chart, keyed by chart name (eg. 'grouped_risk').
+        """
+        super(ChartRenderError, self).__init__(
+            "Failed to render charts: " + ", ".join("%s (%s)" % (k, errors[k]) for k in sorted(errors)))
+        self.errors = errors
+
+
+def _chart_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CHART_WORKERS)
+        return _executor
+
+
+def data_uri(image, mimetype):
+    """Encodes image bytes of the given mimetype as a data URI that can be inlined into HTML."""
+    return 'data:%s;base64,%s' % (mimetype, base64.b64encode(image).decode('ascii'))
+
+
+def file_data_uri(path):
+    """Returns a data URI for a static file, reading it only once per process."""
+    if path not in _data_uris:
+        with open(path, 'rb') as image_file:
+            _data_uris[path] = data_uri(image_file.read(),
+                                        mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    return _data_uris[path]
 
 
 class SurveyReportMaker():
-    def __init__(self, survey_data, user_name, rating, api_cred=None):
+    def __init__(self, survey_data, user_name, rating, api_cred=None, chart_backend=LOCAL_BACKEND,
+                 chart_cache=CHART_CACHE, in_memory=False):
         """Creates Innovation Company survey reports PDF files.
         
         Args:
@@ -33,9 +112,24 @@ class SurveyReportMaker():
             api_cred (2-tuple, str, optional): A 2-tuple containing a Plotly
                 username, and API key; in that order. If not provided, the
                 SurveyReportMaker instance will not log onto Plotly. Note:
-                logging into Plotly is necessary to ultimately print the
-                report.
+                logging into Plotly is necessary to print the report with the
+                Plotly chart backend.
+            chart_backend (str, optional): Either 'local' to draw charts
+                in-process as SVG, or 'plotly' to download them as PNG from
+                the Plot.ly image server. Defaults to 'local'.
+            chart_cache (~chart_cache.ChartCache, optional): Cache consulted
+                before rendering a chart. Pass None to always render.
+            in_memory (bool, optional): If True, charts are kept as in-memory
+                buffers and inlined into the HTML as data URIs instead of
+                being written to temporary files.
         """
+        if chart_backend not in CHART_BACKENDS:
+            raise ValueError("Unknown chart backend: %s" % chart_backend)
+        self.chart_backend = chart_backend
+        # Mimetype of each rendered chart, set by the backend that drew it
+        self.chart_mimetypes = {}
+        self.chart_cache = chart_cache
+        self.in_memory = in_memory
         self.resp_num = len(survey_data)
         self.survey_data = self.process_survey_data(survey_data)
         self.user_name = user_name
@@ -46,6 +140,23 @@ class SurveyReportMaker():
         else:
             self.isLoggedIntoPlotly = False
 
+    @classmethod
+    def from_counts(cls, counts, user_name, rating, **kwargs):
+        """Creates a report maker from a 24-bin response histogram.
+
+        Equivalent to passing one decoded response per counted response code,
+        without building the list of responses.
+
+        Args:
+            counts (list of int): Number of responses of each response code,
+                see ~score_innovation.encode_response.
+            user_name, rating, **kwargs: As ~SurveyReportMaker.
+        """
+        self = cls([], user_name, rating, **kwargs)
+        self.resp_num = sum(counts)
+        self.survey_data = self.process_counts(counts)
+        return self
+
     def plotly_login(self, api_cred):
         """Used to login to Plot.ly graphing API
         
@@ -55,6 +166,7 @@ class SurveyReportMaker():
                 logging into Plotly is necessary to ultimately print the
                 report.
         """
+        import plotly.plotly as plty
         plty.sign_in(*api_cred)
         self.isLoggedIntoPlotly = True
 
@@ -80,25 +192,8 @@ class SurveyReportMaker():
                 sub-dictionary contains keys for 'Risk' and for 'Failure',
                 in which the totals for each category are kept.
         """
-        datamap = {
-            'Risk': {
-                'a': 'High',
-                'b': 'Medium',
-                'c': 'Low',
-                'd': 'No',
-            },
-            'Failure': {
-                'a': 'Supported',
-                'b': 'Injured',
-                'c': 'Booted',
-            },
-        }
-        results = {
-            'Managers': {'Risk': {k: 0 for k in datamap['Risk'].values()},
-                         'Failure': {k: 0 for k in datamap['Failure'].values()}},
-            'Associates': {'Risk': {k: 0 for k in datamap['Risk'].values()},
-                           'Failure': {k: 0 for k in datamap['Failure'].values()}},
-        }
+        datamap = ANSWER_LABELS
+        results = self._empty_results()
         self.resp_asc = 0
         self.resp_man = 0
         for entry in survey_data:
@@ -115,6 +210,30 @@ class SurveyReportMaker():
             results[current_key]['Failure'][fail_val] += 1
         return results
 
+    @staticmethod
+    def _empty_results():
+        return {group: {question: {k: 0 for k in ANSWER_LABELS[question].values()} for question in ANSWER_LABELS}
+                for group in ('Managers', 'Associates')}
+
+    def process_counts(self, counts):
+        """Like ~SurveyReportMaker.process_survey_data, from a 24-bin response histogram."""
+        results = self._empty_results()
+        self.resp_asc = 0
+        self.resp_man = 0
+        for code, n in enumerate(counts):
+            if not n:
+                continue
+            role, risk, failure = decode_response(code)
+            if role == 'ASSOC':
+                current_key = 'Associates'
+                self.resp_asc += n
+            else:
+                current_key = 'Managers'
+                self.resp_man += n
+            results[current_key]['Risk'][ANSWER_LABELS['Risk'][risk]] += n
+            results[current_key]['Failure'][ANSWER_LABELS['Failure'][failure]] += n
+        return results
+
     def return_overall(self, vals):
         """Combines the counts of associates and managers
         
@@ -139,7 +258,19 @@ class SurveyReportMaker():
                 }
         return overall
 
-    def _make_plot(self, data, fname, title=None):
+    def _render_chart(self, fig, backend):
+        """Renders a chart figure with the given backend.
+
+        Returns:
+            (bytes): The image data.
+        """
+        if backend == LOCAL_BACKEND:
+            return chart_renderer.render_svg(fig)
+        import plotly.plotly as plty
+        return plty.image.get(fig, format='png')
+
+    def _make_figure(self, data, title=None):
+        import plotly.graph_objs as gobj
         layout = None
         annotations = None
         text_angle = -35
@@ -215,26 +346,78 @@ class SurveyReportMaker():
                                      ticks='',
                                      showticklabels=False
                                  ))
-        fig = gobj.Figure(data=data, layout=layout)
-        setattr(self, fname, tempfile.NamedTemporaryFile(mode='wb', suffix='.png'))
+        return gobj.Figure(data=data, layout=layout)
+
+    def _make_plot(self, fig, fname, backend=None):
+        backend = backend or self.chart_backend
+        image = None
+        if self.chart_cache is not None:
+            title = fig['layout'].get('title')
+            key = self.chart_cache.make_key(fname + (':' + title if title else ''),
+                                            [trace['y'] for trace in fig['data']], backend)
+            image = self.chart_cache.get(key)
+        if image is None:
+            image = self._render_chart(fig, backend)
+            if self.chart_cache is not None:
+                self.chart_cache.put(key, image)
+        if self.in_memory:
+            return io.BytesIO(image)
+        chart = tempfile.NamedTemporaryFile(mode='wb', suffix=CHART_SUFFIXES[backend])
+        chart.write(image)
+        chart.flush()
         # Close file if on windows otherwise access denied error
         if __name__ == "__main__":
-            getattr(self, fname).close()
-        plty.image.save_as(fig, filename=getattr(self, fname).name)
+            chart.close()
+            with open(chart.name, 'wb') as chart_file:
+                chart_file.write(image)
+        return chart
 
-    def make_plots(self):
-        """Accesses the Plot.ly API to make the bar charts for the report.
+    def make_plots(self, backend=None):
+        """Makes the bar charts for the report.
 
-        Creates temporary files to download charts from Plot.ly API.
+        Creates temporary files holding the rendered charts, or in-memory
+        buffers if the instance was created with `in_memory`, and stores them
+        as `overall_risk`, `overall_failure`, `grouped_risk` and
+        `grouped_failure`. The four charts are rendered concurrently on a
+        shared, bounded thread pool.
+
+        Args:
+            backend (str, optional): 'local' or 'plotly'; overrides the
+                backend chosen when the instance was created. The Plotly
+                backend remains available as a fallback for the local one.
+
+        Raises:
+            ChartRenderError: If any chart failed to render. The charts that
+                did render are still stored on the instance.
         """
-        overall = self.return_overall(self.survey_data.values())
-        typs = overall.keys()
+        if backend is not None and backend not in CHART_BACKENDS:
+            raise ValueError("Unknown chart backend: %s" % backend)
+        executor = _chart_executor()
+        futures = [(fname, executor.submit(self._make_plot, fig, fname, backend=backend))
+                   for fname, fig in self.make_figures()]
+        errors = {}
+        for fname, future in futures:
+            try:
+                setattr(self, fname, future.result())
+                self.chart_mimetypes[fname] = CHART_MIMETYPES[backend or self.chart_backend]
+            except Exception as e:
+                errors[fname] = e
+        if errors:
+            raise ChartRenderError(errors)
 
-        for typ in typs:
-            if typ == 'Failure':
-                keys = ['Supported', 'Injured', 'Booted']
-            else:
-                keys = ['High', 'Medium', 'Low', 'No']
+    def make_figures(self):
+        """Builds the bar chart figures of the report without rendering them.
+
+        Returns:
+            (list of 2-tuple of str, ~plotly.graph_objs.Figure): The chart
+                name and figure of each chart, Risk charts first.
+        """
+        import plotly.graph_objs as gobj
+        overall = self.return_overall(list(self.survey_data.values()))
+        plots = []
+
+        for typ in ('Risk', 'Failure'):
+            keys = list(CHART_KEYS[typ])
 
             overall_data = [gobj.Bar(
                 marker=dict(color='rgb(165, 209, 121)'),
@@ -256,35 +439,93 @@ class SurveyReportMaker():
                 name="Associates",
                 # width=.5
             )
-            self._make_plot(overall_data, "overall_" + typ.lower())
-            self._make_plot([man_data, assoc_data], "grouped_" + typ.lower())
+            plots.append(("overall_" + typ.lower(), self._make_figure(overall_data)))
+            plots.append(("grouped_" + typ.lower(), self._make_figure([man_data, assoc_data])))
+        return plots
+
+    def chart_data(self):
+        """Returns the counts behind the report charts, for drawing them in the browser.
+
+        Returns:
+            (dict of str => dict of str => list): For 'Risk' and 'Failure',
+                the bar 'labels' in chart order and the 'Managers' and
+                'Associates' count of each bar. The overall charts are their
+                sums.
+        """
+        return {typ: dict({'labels': list(keys)},
+                          **{group: [self.survey_data[group][typ][k] for k in keys]
+                             for group in ('Managers', 'Associates')})
+                for typ, keys in CHART_KEYS.items()}
 
-    def write_to_pdf(self, html, config, ofname=""):
+    def write_to_pdf(self, html, config, ofname="", pool=None, timeout=None, engine=WKHTMLTOPDF_ENGINE):
         """Uses pdfkit to write a PDF file based on HTML string input.
 
-        Closes all the 
-        
+        The conversion is submitted to a ~pdf_pool.PdfRenderPool, which bounds
+        the number of `wkhtmltopdf` processes running at once. With the
+        'direct' engine the report is instead drawn in-process by
+        ~pdf_writer.write_report_pdf and `html`, `config`, `pool` and
+        `timeout` are ignored. Closes all the chart files or buffers created
+        by ~SurveyReportMaker.make_plots.
+
         Args:
             html (str): HTML input string, representing Innovation Company
                 report.
             ofname (str): Output file name.
             config (~pdfkit.configuration): pdfkit configuration object,
                 may be necessary to point to the `wkhtmltopdf` executable.
+            pool (~pdf_pool.PdfRenderPool, optional): Pool to render on.
+                Defaults to the process-wide pool.
+            timeout (int, optional): Seconds `wkhtmltopdf` may run before it
+                is killed. Defaults to the pool timeout.
+            engine (str, optional): 'wkhtmltopdf' or 'direct'.
+
+        Returns:
+            (bytes): The PDF if `ofname` is empty, otherwise None.
         """
+        if engine not in PDF_ENGINES:
+            raise ValueError("Unknown PDF engine: %s" % engine)
         pdf = None
         try:
-            if ofname == "":
-                pdf = pdfkit.from_string(html, False, configuration=config)
-                # pdfkit.from_string(html, ofname, configuration=config)
+            if engine == DIRECT_ENGINE:
+                pdf = pdf_writer.write_report_pdf(self)
             else:
-                pdfkit.from_string(html, ofname, configuration=config)
-                # pdfkit.from_string(html, ofname)
+                pool = pool or pdf_pool.default_pool()
+                pdf = pool.render(html, config=config, timeout=timeout)
+            if ofname != "":
+                with open(ofname, 'wb') as pdf_file:
+                    pdf_file.write(pdf)
+                pdf = None
         finally:
-            self.grouped_failure.close()
-            self.grouped_risk.close()
-            self.overall_failure.close()
-            self.overall_risk.close()
-            return pdf
+            self.close_charts()
+        return pdf
+
+    def close_charts(self):
+        """Closes the chart files or buffers created by ~SurveyReportMaker.make_plots"""
+        for name in CHART_NAMES:
+            chart = getattr(self, name, None)
+            if chart is not None:
+                chart.close()
+
+    def load_charts(self, images, chart_mimetypes=None):
+        """Restores previously rendered charts as in-memory buffers.
+
+        Args:
+            images (dict of str => bytes): Image data keyed by chart name, see
+                ~CHART_NAMES.
+            chart_mimetypes (dict of str => str, optional): Mimetype of each
+                image, as stored in `chart_mimetypes` by
+                ~SurveyReportMaker.make_plots. Defaults to the mimetype of the
+                instance's chart backend.
+        """
+        for name in CHART_NAMES:
+            setattr(self, name, io.BytesIO(images[name]))
+            self.chart_mimetypes[name] = (chart_mimetypes or {}).get(name, CHART_MIMETYPES[self.chart_backend])
+
+    def _chart_src(self, name):
+        chart = getattr(self, name)
+        if isinstance(chart, io.BytesIO):
+            return data_uri(chart.getvalue(), self.chart_mimetypes[name])
+        return os.path.abspath(chart.name)
 
     def make_html_page(self, logopath):
         """Creates an HTML markup of Innovation Company report
@@ -293,7 +534,9 @@ class SurveyReportMaker():
         method.
         
         Args:
-            logopath (str): The path to the Innovation Company logo file.
+            logopath (str): The path to the Innovation Company logo file. In
+                `in_memory` mode the logo is inlined as a data URI, read from
+                disk only once per process.
         
         Returns:
             (str): A HTML markup of the Innovation Company report which can
@@ -304,6 +547,7 @@ class SurveyReportMaker():
         self.resp_asc = str(self.resp_asc)
         self.resp_man = str(self.resp_man)
         self.rating = self.rating if self.rating else ""
+        logo = file_data_uri(logopath) if self.in_memory else logopath
         return """<html>
 <head>
 </head>
@@ -347,7 +591,7 @@ class SurveyReportMaker():
     height: 50px;
 } 
 </style>
-<img src=""" + logopath + """ />
+<img src=""" + logo + """ />
 <h3>Thank you for using The Innovation Company's I3&trade; Assessment Tool.  Below are your results.</h3>
 <div id="wrap">
     <div id="left_col">
@@ -371,15 +615,15 @@ class SurveyReportMaker():
     </tr>
     <tr>
         <td class="tdl">Overall</td>
-        <td class="tdw tdcenter"><img src=""" + os.path.abspath(self.overall_risk.name) + """ border=1 style="border-color: #D3D3D3" /></td>
+        <td class="tdw tdcenter"><img src=""" + self._chart_src("overall_risk") + """ border=1 style="border-color: #D3D3D3" /></td>
         <td class="tdcenter vertical_dotted_line"></td>
-        <td class="tdw tdcenter"><img src=""" + os.path.abspath(self.overall_failure.name) + """ border=1 style="border-color: #D3D3D3" /></td>
+        <td class="tdw tdcenter"><img src=""" + self._chart_src("overall_failure") + """ border=1 style="border-color: #D3D3D3" /></td>
     </tr>
     <tr>
         <td class="tdl">By manager and associate</td>
-        <td class="tdw tdcenter"><img src=""" + os.path.abspath(self.grouped_risk.name) + """ border=1 style="border-color: #D3D3D3" /></td>
+        <td class="tdw tdcenter"><img src=""" + self._chart_src("grouped_risk") + """ border=1 style="border-color: #D3D3D3" /></td>
         <td class="tdcenter vertical_dotted_line"></td>
-        <td class="tdw tdcenter"><img src=""" + os.path.abspath(self.grouped_failure.name) + """ border=1 style="border-color: #D3D3D3" /></td>
+        <td class="tdw tdcenter"><img src=""" + self._chart_src("grouped_failure") + """ border=1 style="border-color: #D3D3D3" /></td>
     </tr>
 </table>
 <p>
@@ -409,6 +653,7 @@ class SurveyReportMaker():
 
 if __name__ == '__main__':
     import csv
+    import pdfkit
 
     with open("Company 1.csv", 'rb') as cpin:
         cPinReader = csv.reader(cpin, delimiter=',')
@@ -416,7 +661,7 @@ if __name__ == '__main__':
         sData = [line for line in cPinReader]
         sData = [['MGR', 'a', 'a'], ['MGR', 'b', 'b'], ['ASSOC', 'c', 'c'], ]
         apiCred = ('innovationiseasy', 'ZHBgmFenRod0v8WvH4OE')
-        srMaker = SurveyReportMaker(sData, "Crimson Star Software", "WARM TO COLD", apiCred)
+        srMaker = SurveyReportMaker(sData, "Crimson Star Software", "WARM TO COLD", apiCred, chart_backend=PLOTLY_BACKEND)
         srMaker.make_plots()
         pg = srMaker.make_html_page(os.path.join(os.getcwd(), "innovation_company_logo.png"))
         config = pdfkit.configuration(wkhtmltopdf="C:\\Program Files\\wkhtmltopdf\\bin\\wkhtmltopdf.exe")
@@ -1,3 +1,773 @@
-from django.test import TestCase
+"""Query-count and latency budgets for the views in main/urls.py
 
-# Create your tests here.
+Seeds synthetic users, surveys and responses at each size in BUDGET_SIZES
+(10, 1k and 100k responses by default), drives every view through the test
+client and records its query count and wall time. A view fails if it exceeds
+its query budget in VIEW_BUDGETS at any size, runs more queries as the data
+grows, or gets slower faster than the data grows. Wall time depends on the
+machine, so the seconds budgets are only a loose guard: a view fails if it
+takes LATENCY_SLACK times its budget. Set INSIGHT_LATENCY_SLACK=1 to hold
+views to the budgets themselves.
+
+The CSV exports are streamed to the end inside the measurement. They are
+allowed one more query per chunk of rows and a time budget per thousand rows,
+and the peak memory of each export must stay under STREAM_MEMORY_BUDGET at
+every size.
+
+Runs on SQLite with mail kept in memory and chart and PDF rendering stubbed:
+
+    python manage.py test main --settings=insight.test_settings
+
+Set INSIGHT_BUDGET_SIZES (eg. "10,1000") for a quicker run.
+
+RatingTests checks the count-based scorers against ~score_innovation.get_rating.
+The remaining test cases cover the pieces the views rely on: report job
+leases, the outbox, buffered ingestion, keyset pagination, the chart cache,
+chart mimetypes, the PDF render pool and time-ordered ids.
+"""
+from datetime import timedelta
+from functools import partial
+import glob
+import os
+import random
+import shutil
+from smtplib import SMTPException
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .models import Survey, SurveyResponse, ResponseHistogram, ReportJob, ReportLeaseLost, OutboxMessage, \
+    OutboxAttachment, HISTOGRAM_FIELDS, RATING_PREVIEW_KEY, REPORT_LEASE_SECONDS, REPORT_LOGO_PATH
+from .score_innovation import decode_response, encode_response, get_rating, get_rating_from_counts, get_ratings, \
+    N_COMBINATIONS, N_MGR_COMBINATIONS, RATINGS, SCORE_TOLERANCE
+from .survey_maker import SurveyReportMaker, CHART_NAMES, PLOTLY_BACKEND, file_data_uri
+from . import chart_cache, ingest, pdf_pool, uuids
+from .chart_cache import ChartCache
+from .keyset import paginate, iterate, encode_cursor, InvalidCursor, ITERATE_CHUNK_SIZE, MAX_PAGE_SIZE
+from .management.commands import send_outbox
+from .outbox import flush_outbox, MAX_SEND_ATTEMPTS
+from .urls import urlpatterns
+
+
+BUDGET_SIZES = tuple(int(n) for n in os.environ.get('INSIGHT_BUDGET_SIZES', '10,1000,100000').split(','))
+RESPONSES_PER_SURVEY = 10
+SURVEYS_PER_USER = 10
+OWNER_SHARE = 100  # the measured requester owns one of every OWNER_SHARE surveys
+RUNS = 3
+# Wall time may grow by at most this factor times the growth of the data
+GROWTH_SLACK = 2.0
+# Multiple of the VIEW_BUDGETS seconds a view may take before test_latency_budgets fails
+LATENCY_SLACK = float(os.environ.get('INSIGHT_LATENCY_SLACK', '5'))
+TIME_FLOOR = 0.005  # seconds; faster runs are treated as this fast when comparing growth
+PASSWORD = 'budget-password'
+STREAM_MEMORY_BUDGET = 8 * 1024 * 1024  # bytes allocated at peak while streaming an export
+
+# View name => (maximum queries, maximum seconds) at every size. Query counts include
+# the SAVEPOINT statements of transaction.atomic blocks nested in the test transaction
+VIEW_BUDGETS = {
+    'new_survey_user': (0, 0.5),
+    'manage_surveys': (3, 1.0),
+    'get_link': (5, 0.5),
+    'close_survey': (16, 0.5),
+    'open_survey': (5, 0.5),
+    'rating_preview': (3, 0.5),
+    'rating_preview_revalidate': (2, 0.5),
+    'view_report': (3, 0.5),
+    'email_report': (10, 0.5),
+    'take_survey_start': (6, 0.5),
+    'take_survey_question': (3, 0.5),
+    'take_survey_submit': (15, 0.5),
+    'survey_page': (1, 0.5),
+    'survey_page_submit': (13, 0.5),
+    'submission_received': (0, 0.5),
+    'survey_is_closed': (0, 0.5),
+    'report_sent': (0, 0.5),
+    'report_not_sent': (0, 0.5),
+    'view_data': (2, 0.5),
+    'users_data': (3, 0.5),
+    'surveys_data': (3, 0.5),
+    'responses_data': (3, 0.5),
+    # Streamed: plus one query per ITERATE_CHUNK_SIZE rows, seconds per 1000 rows
+    'export_responses': (3, 0.2),
+    'export_users': (3, 0.2),
+}
+STREAMED_VIEWS = ('export_responses', 'export_users')
+# Measured views whose URL name differs from their VIEW_BUDGETS name
+URL_NAMES = {
+    'take_survey_start': 'take_survey',
+    'take_survey_question': 'take_survey',
+    'take_survey_submit': 'take_survey',
+    'survey_page_submit': 'survey_page',
+    'rating_preview_revalidate': 'rating_preview',
+}
+ANSWERS = {'question_1': 'MGR', 'question_2': 'b', 'question_3': 'a'}
+
+
+def seed(owner, n_responses, start):
+    """Adds users, surveys and submitted responses until there are `n_responses`.
+
+    Counters and histograms are written directly, as the views would have
+    maintained them.
+    """
+    n_surveys = max(1, (n_responses - start) // RESPONSES_PER_SURVEY)
+    n_users = max(1, n_surveys // SURVEYS_PER_USER)
+    password = make_password(PASSWORD)
+    User.objects.bulk_create([User(username='user%d-%d' % (start, i), email='user%d-%d@example.com' % (start, i),
+                                   first_name='First%d' % i, last_name='Last%d' % i, password=password)
+                              for i in range(n_users)])
+    users = list(User.objects.filter(username__startswith='user%d-' % start))
+    surveys = [Survey(requester=owner if i % OWNER_SHARE == 0 else users[i % len(users)],
+                      survey_name='Survey %d' % i, group_name='Group %d' % (i % 50))
+               for i in range(n_surveys)]
+    Survey.objects.bulk_create(surveys)
+    histograms = [ResponseHistogram(survey=survey) for survey in surveys]
+    responses = []
+    for i in range(start, n_responses):
+        index = (i - start) % n_surveys
+        code = i % len(HISTOGRAM_FIELDS)
+        question_1, question_2, question_3 = decode_response(code)
+        responses.append(SurveyResponse(survey=surveys[index], submitted=True, question_1=question_1,
+                                        question_2=question_2, question_3=question_3, response_code=code))
+        field = HISTOGRAM_FIELDS[code]
+        setattr(histograms[index], field, getattr(histograms[index], field) + 1)
+        histograms[index].version += 1
+    SurveyResponse.objects.bulk_create(responses, batch_size=500)
+    ResponseHistogram.objects.bulk_create(histograms, batch_size=500)
+    for survey, histogram in zip(surveys, histograms):
+        survey.started_count = survey.submitted_count = histogram.total
+    # One UPDATE per distinct count rather than per survey
+    for total in set(histogram.total for histogram in histograms):
+        Survey.objects.filter(pk__in=[h.survey_id for h in histograms if h.total == total]) \
+            .update(started_count=total, submitted_count=total)
+
+
+def view_requests(owner, staff):
+    """Returns the (name, prepare) of each measured view.
+
+    `prepare` sets up whatever state the view needs, outside the measurement,
+    and returns a callable making the request.
+    """
+    anonymous = Client()
+    requester = Client()
+    requester.login(username=owner.username, password=PASSWORD)
+    staff_client = Client()
+    staff_client.login(username=staff.username, password=PASSWORD)
+
+    def open_survey():
+        return Survey.objects.create(requester=owner, survey_name="Budget", group_name="Budget")
+
+    def closed_survey():
+        survey = open_survey()
+        survey.close()
+        return survey
+
+    def started_response():
+        response = SurveyResponse(survey=open_survey(), question_1='MGR', question_2='b')
+        response.start()
+        return response
+
+    def response_url(response, question):
+        return '/take_survey/%s/%s/%d/' % (response.survey_id, response.pk, question)
+
+    def responded_survey():
+        return Survey.objects.filter(requester=owner).order_by('created_date').first()
+
+    def rating_preview(revalidate):
+        # A seeded survey of the owner's, with its preview not cached yet
+        survey = responded_survey()
+        url = '/rating_preview/%s/' % survey.pk
+        cache.delete(RATING_PREVIEW_KEY % survey.pk)
+        if revalidate:
+            return partial(requester.get, url, HTTP_IF_NONE_MATCH=requester.get(url)['ETag'])
+        return partial(requester.get, url)
+
+    return [
+        ('new_survey_user', lambda: partial(anonymous.get, '/')),
+        ('manage_surveys', lambda: partial(requester.get, '/manage_surveys')),
+        ('get_link', lambda: partial(requester.get, '/get_link/%s/' % open_survey().pk)),
+        ('close_survey', lambda: partial(requester.get, '/close_survey/%s/' % started_response().survey_id)),
+        ('open_survey', lambda: partial(requester.get, '/open_survey/%s/' % closed_survey().pk)),
+        ('rating_preview', partial(rating_preview, False)),
+        ('rating_preview_revalidate', partial(rating_preview, True)),
+        ('view_report', lambda: partial(requester.get, '/report/%s/' % responded_survey().pk)),
+        ('email_report', lambda: partial(requester.post, '/email_report/%s/' % responded_survey().pk)),
+        ('take_survey_start', lambda: partial(anonymous.get, '/take_survey/%s/-1/0/' % open_survey().pk)),
+        ('take_survey_question', lambda: partial(anonymous.get, response_url(started_response(), 1))),
+        ('take_survey_submit', lambda: partial(anonymous.post, response_url(started_response(), 3), {'question': 'a'})),
+        ('survey_page', lambda: partial(anonymous.get, '/survey/%s/' % open_survey().pk)),
+        ('survey_page_submit', lambda: partial(anonymous.post, '/survey/%s/' % open_survey().pk, ANSWERS)),
+        ('submission_received', lambda: partial(anonymous.get, '/submission_received')),
+        ('survey_is_closed', lambda: partial(anonymous.get, '/survey_is_closed')),
+        ('report_sent', lambda: partial(anonymous.get, '/report_sent')),
+        ('report_not_sent', lambda: partial(anonymous.get, '/report_not_sent')),
+        ('view_data', lambda: partial(staff_client.get, '/admin/view_data')),
+        ('users_data', lambda: partial(staff_client.get, '/admin/data/users', {'q': 'First1'})),
+        ('surveys_data', lambda: partial(staff_client.get, '/admin/data/surveys', {'sort': '-created_date'})),
+        ('responses_data', lambda: partial(staff_client.get, '/admin/data/responses', {'sort': 'survey'})),
+        ('export_responses', lambda: partial(staff_client.get, '/admin/export/responses.csv')),
+        ('export_users', lambda: partial(staff_client.get, '/admin/export/users.csv')),
+    ]
+
+
+def _read(response):
+    """Returns the number of CSV rows, after the header, of a streamed response; 0 otherwise."""
+    if not response.streaming:
+        return 0
+    return sum(chunk.count(b'\n') for chunk in response.streaming_content) - 1
+
+
+def measure(request):
+    """Returns the most queries, the least wall time and the rows streamed of RUNS requests.
+
+    Streamed responses are read to the end inside the measurement, and their
+    query count excludes the one keyset query per ITERATE_CHUNK_SIZE rows.
+    """
+    queries = 0
+    seconds = None
+    for _ in range(RUNS):
+        send = request()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.time()
+            response = send()
+            rows = _read(response)
+            elapsed = time.time() - started
+        assert response.status_code in (200, 302, 304), "HTTP %s" % response.status_code
+        chunks = rows // ITERATE_CHUNK_SIZE + 1 if response.streaming else 0
+        queries = max(queries, len(captured) - chunks)
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return queries, seconds, rows
+
+
+def peak_memory(request):
+    """Returns the most bytes allocated at once while making a request and reading its response."""
+    send = request()
+    tracemalloc.start()
+    try:
+        _read(send())
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def seconds_budget(name, rows):
+    seconds = VIEW_BUDGETS[name][1] * LATENCY_SLACK
+    return seconds * max(1, rows / 1000.0) if name in STREAMED_VIEWS else seconds
+
+
+class ViewBudgetTests(TestCase):
+    maxDiff = None
+
+    @classmethod
+    def setUpTestData(cls):
+        # Views only queue reports, but keep chart and PDF rendering offline if one ever runs inline
+        patches = [mock.patch.object(SurveyReportMaker, '_render_chart', return_value=b'<svg/>'),
+                   mock.patch.object(pdf_pool, 'render_pdf', return_value=b'%PDF-1.4')]
+        for patch in patches:
+            patch.start()
+        try:
+            owner = User.objects.create_user('owner@example.com', 'owner@example.com', PASSWORD)
+            staff = User.objects.create_user('staff@example.com', 'staff@example.com', PASSWORD, is_staff=True)
+            cls.results = {}
+            cls.peaks = {}
+            seeded = 0
+            for size in BUDGET_SIZES:
+                seed(owner, size, seeded)
+                seeded = size
+                requests = view_requests(owner, staff)
+                cls.results[size] = {name: measure(request) for name, request in requests}
+                cls.peaks[size] = {name: peak_memory(request) for name, request in requests
+                                   if name in STREAMED_VIEWS}
+        finally:
+            for patch in patches:
+                patch.stop()
+
+    def test_every_url_has_a_budget(self):
+        measured = set(URL_NAMES.get(name, name) for name in VIEW_BUDGETS)
+        self.assertEqual([pattern.name for pattern in urlpatterns if pattern.name not in measured], [])
+
+    def test_query_budgets(self):
+        over = ["%s at %d responses: %d queries (budget %d)" % (name, size, queries, VIEW_BUDGETS[name][0])
+                for size, results in sorted(self.results.items())
+                for name, (queries, _, _) in sorted(results.items())
+                if queries > VIEW_BUDGETS[name][0]]
+        self.assertEqual(over, [])
+
+    def test_latency_budgets(self):
+        over = ["%s at %d responses: %.3fs (budget %.3fs)" % (name, size, seconds, seconds_budget(name, rows))
+                for size, results in sorted(self.results.items())
+                for name, (_, seconds, rows) in sorted(results.items())
+                if seconds > seconds_budget(name, rows)]
+        self.assertEqual(over, [])
+
+    def test_exports_stream_in_constant_memory(self):
+        over = ["%s at %d responses: %d bytes (budget %d)" % (name, size, peak, STREAM_MEMORY_BUDGET)
+                for size, peaks in sorted(self.peaks.items())
+                for name, peak in sorted(peaks.items())
+                if peak > STREAM_MEMORY_BUDGET]
+        self.assertEqual(over, [])
+
+    def test_queries_do_not_grow_with_data(self):
+        smallest, largest = min(self.results), max(self.results)
+        grew = ["%s: %d queries at %d responses, %d at %d" % (name, self.results[smallest][name][0], smallest,
+                                                              self.results[largest][name][0], largest)
+                for name in sorted(VIEW_BUDGETS)
+                if self.results[largest][name][0] > self.results[smallest][name][0]]
+        self.assertEqual(grew, [])
+
+    def test_time_grows_at_most_linearly(self):
+        sizes = sorted(self.results)
+        superlinear = []
+        for small, large in zip(sizes, sizes[1:]):
+            for name in sorted(VIEW_BUDGETS):
+                before = max(self.results[small][name][1], TIME_FLOOR)
+                after = max(self.results[large][name][1], TIME_FLOOR)
+                if after / before > GROWTH_SLACK * large / small:
+                    superlinear.append("%s: %.3fs at %d responses, %.3fs at %d" % (name, before, small, after, large))
+        self.assertEqual(superlinear, [])
+
+
+class RatingTests(TestCase):
+    SURVEYS = 3000
+
+    def random_surveys(self, rng):
+        # Mostly small surveys, where ratings sit closest to the thresholds, some all managers or all
+        # associates, and a few large ones where get_rating's summation order matters most
+        surveys = []
+        for _ in range(self.SURVEYS):
+            codes = rng.choice([range(N_COMBINATIONS), range(N_MGR_COMBINATIONS),
+                                range(N_MGR_COMBINATIONS, N_COMBINATIONS)])
+            size = rng.choice([0, 1, 2, 3, 5, 8, 13, 40, 250, 250, 20000] if len(surveys) % 100 == 0 else
+                              [0, 1, 2, 3, 5, 8, 13, 40, 250])
+            surveys.append([decode_response(rng.choice(codes)) for _ in range(size)])
+        return surveys
+
+    def test_count_based_scores_match_get_rating(self):
+        rng = random.Random(20171)
+        surveys = self.random_surveys(rng)
+        counts = []
+        for responses in surveys:
+            survey_counts = [0] * N_COMBINATIONS
+            for response in responses:
+                survey_counts[encode_response(*response)] += 1
+            counts.append(survey_counts)
+        batch_ratings, batch_scores = get_ratings(counts)
+        mismatched = []
+        for responses, survey_counts, batch_rating, batch_score in zip(surveys, counts, batch_ratings, batch_scores):
+            rating, score = get_rating(responses)
+            count_rating, count_score = get_rating_from_counts(survey_counts)
+            near_threshold = any(abs(score - threshold) <= SCORE_TOLERANCE for threshold, _ in RATINGS)
+            if (count_rating, count_score) != (batch_rating, float(batch_score)) \
+                    or abs(score - count_score) > SCORE_TOLERANCE \
+                    or (rating != count_rating and not near_threshold):
+                mismatched.append((len(responses), (rating, score), (count_rating, count_score),
+                                   (batch_rating, float(batch_score))))
+        self.assertEqual(mismatched, [])
+
+
+def buffered_ingest(test):
+    """Switches `test` to buffered ingestion with a response log in a new temporary directory."""
+    log_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, log_dir)
+    buffered = override_settings(RESPONSE_INGEST_MODE=ingest.BUFFERED_MODE, RESPONSE_LOG_DIR=log_dir)
+    buffered.enable()
+    test.addCleanup(buffered.disable)
+    return log_dir
+
+
+class ReportJobTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner@example.com', 'owner@example.com', PASSWORD)
+        self.survey = Survey.objects.create(requester=self.owner, survey_name="Jobs", group_name="Jobs")
+        self.client.login(username=self.owner.username, password=PASSWORD)
+
+    def test_closing_again_without_new_responses_reuses_the_job(self):
+        buffered_ingest(self)
+        ingest.append(self.survey.pk, 'MGR', 'b', 'a')
+        self.client.get('/close_survey/%s/' % self.survey.pk)
+        # The job's aggregate stage flushes the log too; that must not change the version it is keyed on
+        ingest.flush_responses()
+        self.client.get('/open_survey/%s/' % self.survey.pk)
+        self.client.get('/close_survey/%s/' % self.survey.pk)
+        self.assertEqual(list(ReportJob.objects.values_list('response_version', flat=True)),
+                         [self.survey.response_version()])
+        self.assertEqual(self.survey.response_counts()[SurveyResponse.encode('MGR', 'b', 'a')], 1)
+
+    def test_only_one_worker_holds_the_lease(self):
+        job = ReportJob.enqueue(self.survey)
+        other = ReportJob.objects.get(pk=job.pk)
+        self.assertTrue(job.claim())
+        self.assertFalse(other.claim())
+        self.assertIsNone(ReportJob.claim_next())
+        self.assertEqual((job.status, job.attempts), (ReportJob.RUNNING, 1))
+
+    def test_expired_lease_is_taken_over(self):
+        job = ReportJob.enqueue(self.survey)
+        self.assertTrue(job.claim())
+        ReportJob.objects.filter(pk=job.pk).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        other = ReportJob.claim_next()
+        self.assertEqual((other.pk, other.attempts), (job.pk, 2))
+        self.assertNotEqual(other.lease_owner, job.lease_owner)
+        with self.assertRaises(ReportLeaseLost):
+            job.renew_lease()
+        other.renew_lease()
+
+    def test_renewing_extends_the_lease(self):
+        job = ReportJob.enqueue(self.survey)
+        self.assertTrue(job.claim())
+        ReportJob.objects.filter(pk=job.pk).update(lease_expires=timezone.now() + timedelta(seconds=1))
+        job.renew_lease()
+        job.refresh_from_db()
+        self.assertGreater(job.lease_expires, timezone.now() + timedelta(seconds=REPORT_LEASE_SECONDS - 60))
+        self.assertIsNone(ReportJob.claim_next())
+
+    def test_jobs_wait_for_their_retry_time(self):
+        job = ReportJob.enqueue(self.survey)
+        ReportJob.objects.filter(pk=job.pk).update(run_after=timezone.now() + timedelta(minutes=1))
+        self.assertIsNone(ReportJob.claim_next())
+        ReportJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual(ReportJob.claim_next().pk, job.pk)
+
+
+class OutboxTests(TestCase):
+
+    def queue(self, subject, attachment=None):
+        return OutboxMessage.queue(subject, "Body", ['someone@example.com'], attachment=attachment)
+
+    def status(self, message):
+        message.refresh_from_db()
+        return message.status, message.attempts
+
+    def test_failed_send_is_retried_until_max_attempts(self):
+        message = self.queue("Retried")
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', side_effect=SMTPException("refused")):
+            for attempt in range(1, MAX_SEND_ATTEMPTS):
+                self.assertEqual(flush_outbox(), (0, 1))
+                self.assertEqual(self.status(message), (OutboxMessage.PENDING, attempt))
+            self.assertEqual(flush_outbox(), (0, 1))
+        self.assertEqual(self.status(message), (OutboxMessage.FAILED, MAX_SEND_ATTEMPTS))
+        self.assertEqual(flush_outbox(), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_retry_succeeds_after_a_failure(self):
+        message = self.queue("Retried")
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', side_effect=SMTPException("refused")):
+            flush_outbox()
+        self.assertEqual(flush_outbox(), (1, 0))
+        self.assertEqual(self.status(message), (OutboxMessage.SENT, 2))
+        self.assertEqual([sent.subject for sent in mail.outbox], ["Retried"])
+
+    def test_unreachable_server_leaves_messages_queued(self):
+        message = self.queue("Queued")
+        with mock.patch.object(locmem.EmailBackend, 'open', side_effect=OSError("connection refused")):
+            with self.assertRaises(OSError):
+                flush_outbox()
+        self.assertEqual(self.status(message), (OutboxMessage.PENDING, 0))
+
+    def test_message_left_sending_is_reclaimed_after_its_lease(self):
+        expired = self.queue("Expired")
+        leased = self.queue("Leased")
+        now = timezone.now()
+        OutboxMessage.objects.filter(pk=expired.pk).update(status=OutboxMessage.SENDING,
+                                                           lease_expires=now - timedelta(seconds=1))
+        OutboxMessage.objects.filter(pk=leased.pk).update(status=OutboxMessage.SENDING,
+                                                          lease_expires=now + timedelta(minutes=1))
+        self.assertEqual(flush_outbox(), (1, 0))
+        self.assertEqual([sent.subject for sent in mail.outbox], ["Expired"])
+        self.assertEqual(self.status(leased), (OutboxMessage.SENDING, 0))
+
+    def test_messages_share_an_attachment(self):
+        attachment = OutboxAttachment.objects.create(filename='report.pdf', mimetype='application/pdf',
+                                                     content=b'%PDF-1.4')
+        self.queue("Requester", attachment)
+        self.queue("Admin", attachment)
+        self.assertEqual(flush_outbox(), (2, 0))
+        for sent in mail.outbox:
+            part = sent.message().get_payload()[1]
+            self.assertEqual((part.get_content_type(), part.get_filename(), part.get_payload(decode=True)),
+                             ('application/pdf', 'report.pdf', b'%PDF-1.4'))
+
+    def test_send_outbox_loop_backs_off_while_flushes_fail(self):
+        delays = []
+
+        def sleep(seconds):
+            delays.append(seconds)
+            if len(delays) == 4:
+                raise KeyboardInterrupt
+
+        flushes = [OSError("connection refused"), OSError("connection refused"), (0, 0), (0, 0)]
+        with mock.patch.object(send_outbox, 'flush_outbox', side_effect=flushes), \
+                mock.patch.object(send_outbox.time, 'sleep', sleep):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('send_outbox', loop=True, interval=5.0)
+        self.assertEqual(delays, [10.0, 20.0, 5.0, 5.0])
+
+    def test_password_reset_mail_is_queued(self):
+        User.objects.create_user('reset@example.com', 'reset@example.com', PASSWORD)
+        self.client.post('/password_reset/', {'email': 'reset@example.com'})
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(list(OutboxMessage.objects.values_list('to', flat=True)), ['["reset@example.com"]'])
+
+
+class IngestTests(TestCase):
+
+    def setUp(self):
+        self.log_dir = buffered_ingest(self)
+        owner = User.objects.create_user('owner@example.com', 'owner@example.com', PASSWORD)
+        self.survey = Survey.objects.create(requester=owner, survey_name="Ingest", group_name="Ingest")
+
+    def submitted(self):
+        return SurveyResponse.objects.filter(survey=self.survey, submitted=True).count()
+
+    def test_appends_after_a_rotation_go_to_the_new_log(self):
+        ingest.append(self.survey.pk, 'MGR', 'b', 'a')
+        ingest._rotate(self.log_dir)
+        ingest.append(self.survey.pk, 'ASSOC', 'a', 'b')
+        self.assertEqual(len(glob.glob(os.path.join(self.log_dir, '*' + ingest.SEGMENT_SUFFIX))), 1)
+        self.assertEqual(ingest.flush_responses(), 2)
+        self.assertEqual(self.submitted(), 2)
+        self.assertEqual(sum(self.survey.response_counts()), 2)
+        self.assertEqual(glob.glob(os.path.join(self.log_dir, '*' + ingest.SEGMENT_SUFFIX)), [])
+
+    def test_replayed_segment_is_not_saved_twice(self):
+        ingest.append(self.survey.pk, 'MGR', 'b', 'a')
+        with open(os.path.join(self.log_dir, ingest.LOG_NAME), 'rb') as log:
+            logged = log.read()
+        self.assertEqual(ingest.flush_responses(), 1)
+        # As if the flusher crashed after saving but before removing the segment
+        with open(os.path.join(self.log_dir, '0' + ingest.SEGMENT_SUFFIX), 'wb') as segment:
+            segment.write(logged)
+        self.assertEqual(ingest.flush_responses(), 0)
+        self.assertEqual(self.submitted(), 1)
+
+    def test_responses_submitted_after_close_are_dropped(self):
+        ingest.append(self.survey.pk, 'MGR', 'b', 'a')
+        self.survey.close()
+        ingest.append(self.survey.pk, 'ASSOC', 'a', 'b')
+        self.assertEqual(ingest.flush_responses(), 1)
+        self.assertEqual(list(SurveyResponse.objects.filter(survey=self.survey).values_list('question_1', flat=True)),
+                         ['MGR'])
+        self.assertEqual(self.survey.response_counts()[SurveyResponse.encode('ASSOC', 'a', 'b')], 0)
+
+
+class KeysetTests(TestCase):
+    N_SURVEYS = 25
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner@example.com', 'owner@example.com', PASSWORD)
+        # Few distinct names, so most rows tie on the sort column and are ordered by pk
+        Survey.objects.bulk_create([Survey(requester=owner, survey_name="Survey %d" % i, group_name="Group %d" % (i % 3))
+                                    for i in range(cls.N_SURVEYS)])
+
+    def pages(self, sort, limit):
+        pages = []
+        after = None
+        while True:
+            rows, after = paginate(Survey.objects.all(), sort, after, limit)
+            pages.append([row.pk for row in rows])
+            if after is None:
+                return pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        for sort in ('group_name', '-group_name', 'created_date', '-created_date', 'id'):
+            expected = list(Survey.objects.order_by(sort, ('-' if sort.startswith('-') else '') + 'pk')
+                            .values_list('pk', flat=True))
+            for limit in (1, 4, 5, self.N_SURVEYS - 1):
+                pages = self.pages(sort, limit)
+                self.assertEqual([pk for page in pages for pk in page], expected, (sort, limit))
+                self.assertTrue(all(len(page) == limit for page in pages[:-1]), (sort, limit))
+
+    def test_last_full_page_has_no_next_cursor(self):
+        self.assertEqual([len(page) for page in self.pages('group_name', 5)], [5] * 5)
+        self.assertEqual([len(page) for page in self.pages('group_name', self.N_SURVEYS)], [self.N_SURVEYS])
+        self.assertEqual([len(page) for page in self.pages('group_name', MAX_PAGE_SIZE + 1)], [self.N_SURVEYS])
+
+    def test_invalid_cursor_is_rejected(self):
+        for cursor in ('not a cursor', encode_cursor('Group 1', 'not a uuid')):
+            with self.assertRaises(InvalidCursor):
+                paginate(Survey.objects.all(), 'group_name', cursor)
+
+    def test_iterate_fetches_every_row_in_chunks(self):
+        expected = list(Survey.objects.order_by('pk').values_list('pk', flat=True))
+        for chunk_size in (1, 5, self.N_SURVEYS, self.N_SURVEYS + 1):
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual([row.pk for row in iterate(Survey.objects.all(), chunk_size=chunk_size)], expected)
+            self.assertEqual(len(captured), self.N_SURVEYS // chunk_size + 1, chunk_size)
+
+
+class ChartCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_hits_memory_then_disk(self):
+        key = ChartCache.make_key('overall_risk', [[1, 2, 3]], 'local')
+        charts = ChartCache(directory=self.directory)
+        self.assertIsNone(charts.get(key))
+        charts.put(key, b'<svg/>')
+        self.assertEqual(charts.get(key), b'<svg/>')
+        restarted = ChartCache(directory=self.directory)
+        self.assertEqual(restarted.get(key), b'<svg/>')
+        self.assertEqual(restarted.get(key), b'<svg/>')
+        self.assertEqual((charts.stats()['memory_hits'], charts.stats()['misses']), (1, 1))
+        self.assertEqual((restarted.stats()['disk_hits'], restarted.stats()['memory_hits']), (1, 1))
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        charts = ChartCache(max_entries=2, directory=None)
+        for key in ('a', 'b'):
+            charts.put(key, key.encode('ascii'))
+        charts.get('a')
+        charts.put('c', b'c')
+        self.assertEqual([charts.get(key) for key in ('a', 'b', 'c')], [b'a', None, b'c'])
+
+    def test_disk_tier_evicts_least_recently_used_files(self):
+        charts = ChartCache(max_entries=0, directory=self.directory, max_disk_entries=2, max_disk_bytes=5)
+        for i, key in enumerate(('a', 'b', 'c')):
+            charts.put(key, b'12')
+            # Distinct modification times even on filesystems with coarse timestamps
+            os.utime(charts._path(key), (i, i))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['b.chart', 'c.chart'])
+        self.assertEqual(charts.get('b'), b'12')
+        charts.put('d', b'123')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['b.chart', 'd.chart'])
+        charts.put('e', b'123456')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_key_depends_on_chart_counts_backend_and_style_version(self):
+        key = ChartCache.make_key('overall_risk', [[1, 2, 3]], 'local')
+        self.assertEqual(ChartCache.make_key('overall_risk', [(1.0, 2, 3)], 'local'), key)
+        others = [ChartCache.make_key('overall_failure', [[1, 2, 3]], 'local'),
+                  ChartCache.make_key('overall_risk', [[1, 2, 4]], 'local'),
+                  ChartCache.make_key('overall_risk', [[1, 2, 3]], 'plotly')]
+        with mock.patch.object(chart_cache, 'STYLE_VERSION', chart_cache.STYLE_VERSION + 1):
+            others.append(ChartCache.make_key('overall_risk', [[1, 2, 3]], 'local'))
+        self.assertEqual(len(set(others + [key])), 5)
+
+
+class ChartMimetypeTests(SimpleTestCase):
+    IMAGES = {'overall_risk': b'<svg/>', 'overall_failure': b'<svg/>',
+              'grouped_risk': b'\xff\xd8\xff\xe0', 'grouped_failure': b'%PDF-1.4'}
+
+    def test_data_uris_carry_the_mimetype_each_chart_was_rendered_as(self):
+        srMaker = SurveyReportMaker.from_counts([0] * N_COMBINATIONS, "Name", "HOT", in_memory=True)
+        srMaker.load_charts(self.IMAGES, {'grouped_risk': 'image/jpeg', 'grouped_failure': 'application/pdf'})
+        self.assertEqual([srMaker._chart_src(name).split(';')[0] for name in CHART_NAMES],
+                         ['data:image/svg+xml', 'data:image/svg+xml', 'data:image/jpeg', 'data:application/pdf'])
+
+    def test_charts_default_to_the_backend_mimetype(self):
+        srMaker = SurveyReportMaker.from_counts([0] * N_COMBINATIONS, "Name", "HOT", chart_backend=PLOTLY_BACKEND,
+                                                in_memory=True)
+        srMaker.load_charts(self.IMAGES)
+        self.assertEqual(set(srMaker._chart_src(name).split(';')[0] for name in CHART_NAMES), {'data:image/png'})
+
+    def test_file_data_uri_uses_the_file_type(self):
+        logo = os.path.join(os.path.dirname(os.path.dirname(__file__)), REPORT_LOGO_PATH)
+        self.assertTrue(file_data_uri(logo).startswith('data:image/png;base64,'))
+
+
+class PdfPoolTests(SimpleTestCase):
+
+    def pool(self, render, **kwargs):
+        pool = pdf_pool.PdfRenderPool(**kwargs)
+        patch = mock.patch.object(pdf_pool, 'render_pdf', render)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_waiting_for_a_pending_job_times_out(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        pool = self.pool(lambda *args: release.wait(5) and b'%PDF', workers=1)
+        job = pool.submit('<html/>')
+        with self.assertRaises(pdf_pool.PdfRenderTimeout):
+            job.result(timeout=0.05)
+        release.set()
+        self.assertEqual(job.result(timeout=5), b'%PDF')
+
+    def test_render_timeouts_are_raised_and_counted(self):
+        def render(html, config, options, timeout):
+            raise pdf_pool.PdfRenderTimeout("wkhtmltopdf did not finish within %s seconds" % timeout)
+
+        pool = self.pool(render, timeout=7)
+        with self.assertRaises(pdf_pool.PdfRenderTimeout):
+            pool.render('<html/>')
+        self.assertEqual((pool.stats()['timed_out'], pool.stats()['completed']), (1, 0))
+
+    def test_full_queue_rejects_jobs_without_blocking(self):
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def render(*args):
+            started.set()
+            release.wait(5)
+            return b'%PDF'
+
+        pool = self.pool(render, workers=1, max_queue=1)
+        running = pool.submit('<html/>')
+        self.assertTrue(started.wait(5))
+        queued = pool.submit('<html/>', block=False)
+        with self.assertRaises(pdf_pool.PdfQueueFull):
+            pool.submit('<html/>', block=False)
+        self.assertEqual((pool.stats()['busy'], pool.stats()['queue_depth']), (1, 1))
+        release.set()
+        self.assertEqual([running.result(5), queued.result(5)], [b'%PDF', b'%PDF'])
+
+    def test_render_pdf_kills_wkhtmltopdf_after_the_timeout(self):
+        wkhtmltopdf = mock.Mock(**{'command.return_value': [sys.executable, '-c', 'import time; time.sleep(30)']})
+        pdfkit = mock.Mock(PDFKit=mock.Mock(return_value=wkhtmltopdf))
+        started = time.time()
+        with mock.patch.dict(sys.modules, {'pdfkit': pdfkit}):
+            with self.assertRaises(pdf_pool.PdfRenderTimeout):
+                pdf_pool.render_pdf('<html/>', timeout=0.5)
+        self.assertLess(time.time() - started, 10)
+
+
+class UuidTests(SimpleTestCase):
+
+    def assertIncreasing(self, ids):
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(set((u.version, u.variant) for u in ids), {(7, uuid.RFC_4122)})
+
+    def setUp(self):
+        # A fresh generator, so the mocked clocks below start after its last timestamp
+        for name in ('_last_ms', '_counter'):
+            patch = mock.patch.object(uuids, name, 0)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_ids_increase_within_a_millisecond(self):
+        # More ids in one millisecond than the 12-bit counter holds
+        with mock.patch.object(uuids.time, 'time', return_value=1500000000.0):
+            self.assertIncreasing([uuids.time_ordered_uuid() for _ in range(5000)])
+
+    def test_ids_increase_when_the_clock_goes_back(self):
+        clock = iter([1500000001.0, 1500000001.5, 1500000000.0, 1500000000.0, 1500000002.0])
+        with mock.patch.object(uuids.time, 'time', lambda: next(clock)):
+            ids = [uuids.time_ordered_uuid() for _ in range(5)]
+        self.assertIncreasing(ids)
+        self.assertEqual([u.int >> 80 for u in ids], [1500000001000, 1500000001500, 1500000001500,
+                                                     1500000001500, 1500000002000])
+
+    def test_ids_sort_like_their_strings(self):
+        ids = [uuids.time_ordered_uuid() for _ in range(1000)]
+        self.assertIncreasing(ids)
+        self.assertEqual([str(u) for u in ids], sorted(str(u) for u in ids))
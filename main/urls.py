@@ -11,9 +11,13 @@ urlpatterns = [
     url(r'^manage_surveys$', views.manage_surveys, name='manage_surveys'),
     url(r'^close_survey/(?P<pk>[a-f0-9-]+)/$', views.close_survey, name='close_survey'),
     url(r'^open_survey/(?P<pk>[a-f0-9-]+)/$', views.open_survey, name='open_survey'),
+    url(r'^rating_preview/(?P<pk>[a-f0-9-]+)/$', views.rating_preview, name='rating_preview'),
+    url(r'^report/(?P<pk>[a-f0-9-]+)/$', views.view_report, name='view_report'),
+    url(r'^email_report/(?P<pk>[a-f0-9-]+)/$', views.email_report, name='email_report'),
     url(r'^get_link/(?P<pk>[a-f0-9-]+)/$', views.get_link, name='get_link'),
     url(r'^take_survey/(?P<survey_pk>[a-f0-9-]+)/(?P<response_pk>[a-f0-9-]+)/(?P<q_num>\d+)/$', views.take_survey,
         name='take_survey'),
+    url(r'^survey/(?P<survey_pk>[a-f0-9-]+)/$', views.survey_page, name='survey_page'),
     url(r'^submission_received$', views.submission_received, name='submission_received'),
     url(r'^survey_is_closed$', views.survey_is_closed, name='survey_is_closed'),
     url(r'^report_sent$', views.report_sent, name='report_sent'),
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Module for generating time-ordered UUID primary keys
+
+Random uuid4 keys land anywhere in a clustered InnoDB primary key index, so
+every insert touches a random page. Keys from ~time_ordered_uuid start with a
+48-bit millisecond timestamp followed by a 12-bit counter (laid out like
+version 7 UUIDs), so new rows append at the end of the index, while the
+remaining 62 random bits keep them unguessable. They are ordinary UUIDs and
+match the `[a-f0-9-]+` URL patterns like uuid4 keys.
+
+Copywright 2017 The Innovation Company, LLC All rights reserved
+"""
+import os
+import threading
+import time
+import uuid
+
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def time_ordered_uuid():
+    """Returns a new UUID that sorts after every UUID previously returned by this process."""
+    global _last_ms, _counter
+    with _lock:
+        ms = int(time.time() * 1000)
+        if ms > _last_ms:
+            _last_ms = ms
+            _counter = 0
+        else:
+            # Same millisecond or the clock went back: keep counting from the last timestamp
+            _counter += 1
+            if _counter > 0xfff:
+                _last_ms += 1
+                _counter = 0
+        ms, counter = _last_ms, _counter
+    rand = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    value = (ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | rand
+    return uuid.UUID(int=value)
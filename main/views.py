@@ -2,14 +2,31 @@
 from django.contrib.auth.models import User
 from django.shortcuts import render, get_object_or_404, redirect
 from django.template.loader import render_to_string
-
-from .forms import ContactForm, GetCompanyForm, NewUserForm, Question1Form, Question2Form, Question3Form, AddSurveyForm
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.http import Http404, JsonResponse, StreamingHttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.safestring import mark_safe
+from datetime import date, datetime, timedelta
+import csv
+import itertools
+import json
+import uuid
+
+from .forms import ContactForm, GetCompanyForm, NewUserForm, Question1Form, Question2Form, Question3Form, AddSurveyForm, \
+    SurveyForm
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, PasswordResetForm
-from .models import Survey, SurveyResponse, MIN_RESPONSES
+from .models import Survey, SurveyResponse, ResponseHistogram, ReportJob, OutboxMessage, MIN_RESPONSES, \
+    RATING_PREVIEW_KEY
+from .keyset import paginate, iterate, InvalidCursor
+from . import ingest
+from .page_cache import render_question_page
+from .score_innovation import get_rating_from_counts
+from .survey_maker import SurveyReportMaker
 from django.contrib.auth import authenticate, login as login_user, logout as logout_user, get_user_model
 import logging
-from django.core.mail import send_mail, EmailMessage
-import threading
 
 
 logger = logging.getLogger(__name__)
@@ -46,20 +63,20 @@ def new_survey_user(request):
                                               group_name=form.cleaned_data["team_or_company"],
                                               survey_name=form.cleaned_data['survey_name'])
             # Send email to user with link to management console
-            send_mail(subject="Here is Your I3™ Survey Administrator Console Link from The Innovation Company",
-                      message=render_to_string('main/email_manage_body.html', {'domain': request.get_host()}),
-                      from_email='noreply@survey.innovationiseasy.com',
-                      recipient_list=[newUser.email])
+            OutboxMessage.queue(subject="Here is Your I3™ Survey Administrator Console Link from The Innovation Company",
+                                body=render_to_string('main/email_manage_body.html', {'domain': request.get_host()}),
+                                from_email='noreply@survey.innovationiseasy.com',
+                                to=[newUser.email])
             # Send email to user with link to newly created survey
             newSurvey.send_link(request.get_host())
             # Send email to site administrator notifying of new user
-            send_mail(subject="A new user has signed up! - {} {}".format(newUser.first_name, newUser.last_name),
-                      message=render_to_string('main/notify_newuser_email.html',
-                                               {'email': newUser.email,
-                                                'name': newUser.first_name + " " + newUser.last_name,
-                                                'team': newSurvey.group_name}),
-                      from_email='noreply@survey.innovationiseasy.com',
-                      recipient_list=['survey@survey.innovationiseasy.com'])
+            OutboxMessage.queue(subject="A new user has signed up! - {} {}".format(newUser.first_name, newUser.last_name),
+                                body=render_to_string('main/notify_newuser_email.html',
+                                                      {'email': newUser.email,
+                                                       'name': newUser.first_name + " " + newUser.last_name,
+                                                       'team': newSurvey.group_name}),
+                                from_email='noreply@survey.innovationiseasy.com',
+                                to=['survey@survey.innovationiseasy.com'])
             return redirect(manage_surveys)
     else:
         form = NewUserForm()
@@ -84,8 +101,7 @@ def manage_surveys(request):
                                               survey_name=form.cleaned_data['survey_name'])
             newSurvey.send_link(request.get_host())
 
-    surveys = [(survey, len(SurveyResponse.objects.filter(survey_id=survey.pk, submitted=True)))
-               for survey in Survey.objects.filter(requester=request.user)]
+    surveys = Survey.objects.filter(requester=request.user)
     return render(request, 'main/manage_surveys.html', {'surveys': surveys,
                                                         'AddSurveyForm': AddSurveyForm(),
                                                         'MIN_RESPONSES': MIN_RESPONSES})
@@ -102,22 +118,95 @@ def get_link(request, pk):
 def close_survey(request, pk):
     if request.user.is_authenticated():
         survey = get_object_or_404(Survey, requester=request.user, pk=pk)
-        # is_sent = False
         if not survey.closed:
-            threading.Thread(target=survey.send_report).start()
-            # survey.send_report()
-            # is_sent = survey.send_report()
+            ReportJob.enqueue(survey)
             survey.close()
             return redirect(report_sent)
-            # if is_sent:
-            #     return redirect(report_sent)
-            # else:
-            #     return redirect(report_not_sent)
         else:
             return redirect(manage_surveys)
     return redirect(login)
 
 
+# Seconds a cached rating preview is served without checking the database. Submissions
+# drop it from the cache when they commit, so this only bounds staleness across processes
+# that do not share a cache; it is kept well above the manage_surveys poll interval
+RATING_PREVIEW_TTL = 10 * 60
+
+
+def rating_preview(request, pk):
+    """Returns the live counts, score and rating of one of the user's surveys as JSON.
+
+    Polled by the panel on manage_surveys. The ETag is the version of the
+    survey's responses, so a poll sending it back in If-None-Match gets a 304
+    until someone submits a response.
+    """
+    if not request.user.is_authenticated():
+        return JsonResponse({'error': "Log in to see survey ratings"}, status=403)
+    try:
+        # Key on the canonical spelling, which is what ~ResponseHistogram._changed invalidates
+        survey_id = uuid.UUID(pk)
+    except ValueError:
+        raise Http404("No such survey")
+    key = RATING_PREVIEW_KEY % survey_id
+    cached = cache.get(key)
+    if cached is None:
+        survey = get_object_or_404(Survey.objects.select_related('histogram'), pk=survey_id)
+        try:
+            histogram = survey.histogram
+        except ResponseHistogram.DoesNotExist:
+            histogram = ResponseHistogram.rebuild(survey.pk)
+        cached = {'requester_id': survey.requester_id, 'etag': '"%s-%d"' % (survey.pk, histogram.version),
+                  'preview': histogram.preview()}
+        cache.set(key, cached, RATING_PREVIEW_TTL)
+    if cached['requester_id'] != request.user.pk:
+        return JsonResponse({'error': "Not your survey"}, status=404)
+    etag = cached['etag']
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(cached['preview'])
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def view_report(request, pk):
+    """Shows the survey's report as a web page, with the charts drawn by the browser.
+
+    Has the content of the emailed PDF (~SurveyReportMaker.make_html_page)
+    without rendering charts or a PDF; `email_report` still sends the PDF.
+    """
+    if not request.user.is_authenticated():
+        return redirect(login)
+    survey = get_object_or_404(Survey.objects.select_related('histogram'), requester=request.user, pk=pk)
+    counts = survey.response_counts()
+    rating, score = get_rating_from_counts(counts)
+    srMaker = SurveyReportMaker.from_counts(counts, "%s %s" % (request.user.first_name, request.user.last_name),
+                                            rating)
+    return render(request, 'main/report.html', {'survey': survey,
+                                                'srMaker': srMaker,
+                                                'report_date': date.today(),
+                                                # Only numbers and the fixed chart labels, so safe to inline
+                                                'chart_data': mark_safe(json.dumps(srMaker.chart_data())),
+                                                'MIN_RESPONSES': MIN_RESPONSES})
+
+
+def email_report(request, pk):
+    """Queues the survey's PDF report to be emailed to its requester, without closing the survey."""
+    if not request.user.is_authenticated():
+        return redirect(login)
+    survey = get_object_or_404(Survey, requester=request.user, pk=pk)
+    if request.method != 'POST':
+        return redirect(view_report, pk=survey.pk)
+    if sum(survey.response_counts()) < MIN_RESPONSES:
+        return redirect(report_not_sent)
+    # One job per response set: asking again before new responses arrive gets the finished PDF resent
+    job = ReportJob.enqueue(survey)
+    if job.status == ReportJob.DONE and not job.resend():
+        return redirect(report_not_sent)
+    return redirect(report_sent)
+
+
 def report_sent(request):
     return render(request, 'main/report_sent.html', {})
 
@@ -170,7 +259,7 @@ def take_survey(request, survey_pk, response_pk, q_num):
     else:
         surveyResponse = SurveyResponse()
         surveyResponse.survey_id = survey_pk
-        surveyResponse.save()
+        surveyResponse.start()
         return redirect(take_survey, survey_pk=survey_pk, response_pk=surveyResponse.pk, q_num=1)
 
     if surveyResponse.submitted:
@@ -193,16 +282,36 @@ def take_survey(request, survey_pk, response_pk, q_num):
             form = Question3Form(data=request.POST)
             if form.is_valid():
                 surveyResponse.question_3 = form.cleaned_data["question"]
-                surveyResponse.submitted = True
-                surveyResponse.save()
+                surveyResponse.submit()
                 return redirect(submission_received)
 
     if q_num == '3':
-        return render(request, 'main/take_survey_q3.html', {'form': Question3Form()})
+        return render_question_page(request, 'main/take_survey_q3.html', Question3Form)
     elif q_num == '2':
-        return render(request, 'main/take_survey_q2.html', {'form': Question2Form()})
+        return render_question_page(request, 'main/take_survey_q2.html', Question2Form)
     else:  # q_num == '1'
-        return render(request, 'main/take_survey_q1.html', {'form': Question1Form()})
+        return render_question_page(request, 'main/take_survey_q1.html', Question1Form)
+
+
+def survey_page(request, survey_pk):
+    """All three questions on one page, saved as one complete response on submit."""
+    survey = get_object_or_404(Survey, pk=survey_pk)
+
+    if survey.closed:
+        return redirect(survey_is_closed)
+
+    if request.method == 'POST':
+        form = SurveyForm(data=request.POST)
+        if form.is_valid():
+            answers = (form.cleaned_data['question_1'], form.cleaned_data['question_2'],
+                       form.cleaned_data['question_3'])
+            if ingest.buffered():
+                ingest.append(survey.pk, *answers)
+            else:
+                SurveyResponse.create_submitted(survey.pk, *answers)
+            return redirect(submission_received)
+        return render(request, 'main/take_survey.html', {'form': form, 'action': request.get_full_path()})
+    return render_question_page(request, 'main/take_survey.html', SurveyForm)
 
 
 def submission_received(request):
@@ -216,14 +325,150 @@ def survey_is_closed(request):
 def view_data(request):
     if request.user.is_authenticated():
         if request.user.is_staff:
-            surveys = [(survey, len(SurveyResponse.objects.filter(survey_id=survey.pk)))
-                       for survey in Survey.objects.all() if not survey.requester.is_staff]
-            return render(request,
-                          'main/view_data.html',
-                          {'surveys': surveys,
-                           'responses': SurveyResponse.objects.filter(survey__requester__is_staff=False),
-                           'users': User.objects.filter(is_staff=False)})
+            return render(request, 'main/view_data.html', {'page_size': STAFF_PAGE_SIZE})
         else:
             return render(request, 'main/not_staff.html', {})
     else:
         return redirect(login)
+
+
+STAFF_PAGE_SIZE = 25
+
+
+def _staff_page(request, queryset, sorts, search_fields, row):
+    """Returns a JSON page of rows for the staff data tables.
+
+    Query parameters are `sort` (one of `sorts`, '-' prefixed for descending
+    order), `q` (case insensitive search of `search_fields`), `after` (cursor
+    from the previous page's 'next') and `limit`.
+    """
+    if not request.user.is_authenticated() or not request.user.is_staff:
+        return JsonResponse({'error': "Staff only"}, status=403)
+    sort = request.GET.get('sort', sorts[0])
+    if sort.lstrip('-') not in sorts:
+        return JsonResponse({'error': "Cannot sort by %s" % sort}, status=400)
+    search = request.GET.get('q', '').strip()
+    if search:
+        match = Q()
+        for field in search_fields:
+            match |= Q(**{field + '__icontains': search})
+        queryset = queryset.filter(match)
+    try:
+        rows, next_cursor = paginate(queryset, sort, request.GET.get('after'),
+                                     request.GET.get('limit', STAFF_PAGE_SIZE))
+    except (InvalidCursor, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'results': [row(obj) for obj in rows], 'next': next_cursor})
+
+
+def users_data(request):
+    return _staff_page(request, User.objects.filter(is_staff=False),
+                       sorts=('id', 'username'),
+                       search_fields=('first_name', 'last_name', 'email'),
+                       row=lambda user: {'id': user.pk, 'last_login': user.last_login,
+                                         'first_name': user.first_name, 'last_name': user.last_name,
+                                         'email': user.email, 'date_joined': user.date_joined})
+
+
+def surveys_data(request):
+    return _staff_page(request, Survey.objects.filter(requester__is_staff=False).select_related('requester'),
+                       sorts=('created_date', 'survey_name', 'group_name'),
+                       search_fields=('survey_name', 'group_name', 'requester__first_name',
+                                      'requester__last_name'),
+                       row=lambda survey: {'id': survey.pk, 'survey_name': survey.survey_name,
+                                           'submitted_count': survey.submitted_count,
+                                           'started_count': survey.started_count, 'closed': survey.closed,
+                                           'group_name': survey.group_name,
+                                           'created_date': survey.created_date,
+                                           'requester_id': survey.requester_id,
+                                           'requester': "%s %s" % (survey.requester.first_name,
+                                                                   survey.requester.last_name)})
+
+
+def responses_data(request):
+    return _staff_page(request, SurveyResponse.objects.filter(survey__requester__is_staff=False)
+                       .select_related('survey'),
+                       sorts=('survey', 'id'),
+                       search_fields=('survey__survey_name', 'survey__group_name'),
+                       row=lambda response: {'id': response.pk, 'survey_id': response.survey_id,
+                                             'survey_name': response.survey.survey_name,
+                                             'group_name': response.survey.group_name,
+                                             'question_1': response.question_1,
+                                             'question_2': response.question_2,
+                                             'question_3': response.question_3})
+
+
+class _Echo(object):
+    """File-like object whose write returns the value written, for streaming csv output."""
+    def write(self, value):
+        return value
+
+
+EXPORT_COLUMNS = {
+    'responses': ('response_id', 'survey_id', 'survey_name', 'group_name', 'requester_id', 'submitted',
+                  'submitted_date', 'question_1', 'question_2', 'question_3'),
+    'users': ('user_id', 'last_login', 'first_name', 'last_name', 'email', 'date_joined'),
+}
+
+
+def _day_range(field, since, until):
+    """Returns filters for `field` between the start of `since` and the end of `until`, in local time.
+
+    Bounds are aware datetimes rather than `__date` lookups, which compile to
+    a per-row CONVERT_TZ on MySQL that cannot use the column's index.
+    """
+    filters = {}
+    if since:
+        filters[field + '__gte'] = timezone.make_aware(datetime.combine(since, datetime.min.time()))
+    if until:
+        filters[field + '__lt'] = timezone.make_aware(datetime.combine(until + timedelta(days=1),
+                                                                       datetime.min.time()))
+    return filters
+
+
+def _export_rows(table, params):
+    """Returns the filtered queryset and row function of a staff CSV export.
+
+    Filters are `survey` (survey id), `requester` (user id) and `since`/`until`
+    (inclusive dates, YYYY-MM-DD) on the response submission date or the user
+    join date.
+    """
+    since, until = (parse_date(params[name]) if params.get(name) else None for name in ('since', 'until'))
+    if (params.get('since') and not since) or (params.get('until') and not until):
+        raise ValueError("dates must be YYYY-MM-DD")
+    if table == 'responses':
+        queryset = SurveyResponse.objects.filter(survey__requester__is_staff=False).select_related('survey')
+        if params.get('survey'):
+            queryset = queryset.filter(survey_id=params['survey'])
+        if params.get('requester'):
+            queryset = queryset.filter(survey__requester_id=params['requester'])
+        queryset = queryset.filter(**_day_range('submitted_date', since, until))
+        return queryset, lambda r: (r.pk, r.survey_id, r.survey.survey_name, r.survey.group_name,
+                                    r.survey.requester_id, r.submitted, r.submitted_date,
+                                    r.question_1, r.question_2, r.question_3)
+    queryset = User.objects.filter(is_staff=False)
+    if params.get('survey'):
+        queryset = queryset.filter(survey__pk=params['survey'])
+    if params.get('requester'):
+        queryset = queryset.filter(pk=params['requester'])
+    queryset = queryset.filter(**_day_range('date_joined', since, until))
+    return queryset, lambda u: (u.pk, u.last_login, u.first_name, u.last_name, u.email, u.date_joined)
+
+
+def export_data(request, table):
+    if not request.user.is_authenticated():
+        return redirect(login)
+    if not request.user.is_staff:
+        return render(request, 'main/not_staff.html', {})
+    try:
+        queryset, row = _export_rows(table, request.GET)
+        # Evaluate the filters now so bad parameters fail before streaming starts
+        queryset.exists()
+    except (ValueError, ValidationError) as e:
+        return HttpResponseBadRequest("Invalid export filter: %s" % e)
+    writer = csv.writer(_Echo())
+    lines = itertools.chain([writer.writerow(EXPORT_COLUMNS[table])],
+                            (writer.writerow(row(obj)) for obj in iterate(queryset)))
+    response = StreamingHttpResponse(lines, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % table
+    return response